@@ -0,0 +1,167 @@
+import asyncio
+import ipaddress
+import math
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request
+from config import (
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_QUEUE,
+    ADMISSION_DEADLINE,
+    RATE_LIMIT_PER_MINUTE,
+    RATE_LIMIT_BURST,
+    CHAT_RATE_LIMIT_PER_MINUTE,
+    CHAT_RATE_LIMIT_BURST,
+    TRUSTED_PROXY_HOPS,
+    TRUSTED_PROXIES,
+    CLIENT_IP_HEADER,
+)
+from metrics import Counter, Gauge
+
+REJECTED = Counter("admission_rejected_total", "Requests rejected by admission control", ("reason",))
+LLM_WAITING = Gauge("llm_requests_waiting", "Requests waiting for an LLM slot")
+LLM_ACTIVE = Gauge("llm_requests_active", "Requests holding an LLM slot")
+
+def reject(status_code: int, reason: str, retry_after: float):
+    REJECTED.inc(reason=reason)
+    return HTTPException(
+        status_code=status_code,
+        detail="Too many requests" if status_code == 429 else "Service overloaded",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+def parse_networks(cidrs: list[str]) -> list:
+    return [ipaddress.ip_network(cidr, strict=False) for cidr in cidrs]
+
+TRUSTED_NETWORKS = parse_networks(TRUSTED_PROXIES)
+
+def is_trusted(host: str | None, networks) -> bool:
+    try:
+        address = ipaddress.ip_address(host or "")
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+def client_key(request: Request, hops: int = TRUSTED_PROXY_HOPS, header: str | None = CLIENT_IP_HEADER, proxies=None) -> str:
+    """
+    レート制限に使うクライアントのアドレス。
+    転送ヘッダは信用するプロキシ(proxies)から届いた接続でだけ使う。
+    X-Forwarded-Forの左側はクライアントが自由に書けるため、信用するプロキシが追記した右からhops番目を使う。
+    """
+    peer = request.client.host if request.client else None
+    if hops > 0 and is_trusted(peer, TRUSTED_NETWORKS if proxies is None else proxies):
+        if header:
+            value = request.headers.get(header, "").strip()
+            if value:
+                return value
+        forwarded = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if forwarded:
+            return forwarded[max(len(forwarded) - hops, 0)]
+    return peer or "unknown"
+
+class RateLimiter:
+    """キー(クライアントやチャット)ごとのトークンバケット。保持するキーの数には上限を設ける"""
+    def __init__(self, per_minute: float = RATE_LIMIT_PER_MINUTE, burst: int = RATE_LIMIT_BURST, max_clients: int = 10000, reason: str = "rate_limit"):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.reason = reason
+        self.max_clients = max_clients
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def check(self, key: str):
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            raise reject(429, self.reason, (1 - tokens) / self.rate)
+        self._buckets[key] = (tokens - 1, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+
+class ChatLocks:
+    """同じチャットのターンを1つずつ処理する"""
+    def __init__(self, timeout: float = ADMISSION_DEADLINE):
+        self.timeout = timeout
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._users: dict[str, int] = {}
+
+    async def acquire(self, chat_id: str):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._users[chat_id] = self._users.get(chat_id, 0) + 1
+        try:
+            await asyncio.wait_for(lock.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._forget(chat_id)
+            raise reject(429, "chat_busy", 1)
+        except BaseException:
+            self._forget(chat_id)
+            raise
+
+    def release(self, chat_id: str):
+        self._locks[chat_id].release()
+        self._forget(chat_id)
+
+    def _forget(self, chat_id: str):
+        self._users[chat_id] -= 1
+        if self._users[chat_id] == 0:
+            del self._users[chat_id]
+            del self._locks[chat_id]
+
+class Governor:
+    """
+    LLM呼び出しの同時実行数を制限し、待ち行列の長さを制限する。
+    平均の処理時間から待ち時間を見積もり、期限を超えそうなリクエストは待たせずに503で断る。
+    """
+    def __init__(self, max_concurrent: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE, deadline: float = ADMISSION_DEADLINE):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.active = 0
+        self.waiting = 0
+        # 1リクエストがスロットを使う時間の指数移動平均(秒)
+        self.service_time = 2.0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    def estimated_wait(self) -> float:
+        return (self.waiting + 1) * self.service_time / self.max_concurrent
+
+    async def acquire(self) -> float:
+        if self.active >= self.max_concurrent:
+            if self.waiting >= self.max_queue:
+                raise reject(503, "queue_full", self.estimated_wait())
+            if self.estimated_wait() > self.deadline:
+                raise reject(503, "deadline", self.estimated_wait())
+        self.waiting += 1
+        LLM_WAITING.inc()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.deadline)
+        except asyncio.TimeoutError:
+            raise reject(503, "timeout", self.estimated_wait())
+        finally:
+            self.waiting -= 1
+            LLM_WAITING.dec()
+        self.active += 1
+        LLM_ACTIVE.inc()
+        return time.monotonic()
+
+    async def try_acquire(self) -> float | None:
+        """空きがあればスロットを取る。待っているリクエストがあるか空きがなければ待たずにNoneを返す"""
+        if self.waiting or self._semaphore.locked():
+            return None
+        await self._semaphore.acquire()
+        self.active += 1
+        LLM_ACTIVE.inc()
+        return time.monotonic()
+
+    def release(self, acquired_at: float):
+        self.active -= 1
+        LLM_ACTIVE.dec()
+        self._semaphore.release()
+        self.service_time = 0.9 * self.service_time + 0.1 * (time.monotonic() - acquired_at)
+
+rate_limiter = RateLimiter()
+chat_rate_limiter = RateLimiter(CHAT_RATE_LIMIT_PER_MINUTE, CHAT_RATE_LIMIT_BURST, reason="chat_rate_limit")
+chat_locks = ChatLocks()
+governor = Governor()
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+from config import (
+    OPENAI_MODEL,
+    RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_PATH,
+)
+from prompt import PROMPT_VERSION
+
+def normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def cache_key(messages: list[dict], generation: str = "", model: str = OPENAI_MODEL) -> str:
+    """generationにはメニューの内容から作った値を渡し、メニューが変われば別のキーにする"""
+    payload = [PROMPT_VERSION, model, generation] + [[m["role"], normalize(m["content"])] for m in messages]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class MemoryBackend:
+    """ワーカー内のLRU。件数の上限とTTLで古いものから捨てる"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str):
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+class SqliteBackend:
+    """
+    ローカルのSQLiteファイルに保存し、同じホストのワーカー間で共有する。
+    他のワーカーの書き込みでロックを待つことがあるため、ResponseCacheはスレッドプールで呼び出す。
+    """
+    blocking = True
+
+    def __init__(self, path: str, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_used_at ON response_cache (used_at)")
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM response_cache WHERE key = ? AND expires_at >= ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE response_cache SET used_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            # 期限切れと、上限を超えた最も古く使われたものを捨てる
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+class ResponseCache:
+    """
+    モデルへの入力が同じ応答を再利用する。
+    プロンプトのバージョンとメニューの内容はキーに含まれるため、変更されれば自然に別のキーになり、
+    古い応答は削除せずTTLと件数の上限で捨てる。
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    async def _call(self, fn, *args):
+        if getattr(self.backend, "blocking", False):
+            return await run_in_threadpool(fn, *args)
+        return fn(*args)
+
+    async def get(self, key: str) -> str | None:
+        if self.backend is None:
+            return None
+        value = await self._call(self.backend.get, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        if self.backend is not None:
+            await self._call(self.backend.set, key, value)
+
+    async def record(self, key: str, deltas):
+        """ストリームをそのまま流しつつ、最後まで受け取れた応答だけを保存する"""
+        chunks = []
+        async for delta in deltas:
+            chunks.append(delta)
+            yield delta
+        await self.set(key, "".join(chunks))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": RESPONSE_CACHE_BACKEND,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+def create_backend(name: str):
+    if name == "memory":
+        return MemoryBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+    if name == "sqlite":
+        return SqliteBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+    if name == "none":
+        return None
+    raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND: {name}")
+
+response_cache = ResponseCache(create_backend(RESPONSE_CACHE_BACKEND))
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import re
+import time
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from db import Menu
+from config import CATALOG_REFRESH_SECONDS, CATALOG_MAX_ITEMS, CATALOG_MAX_LISTED
+
+# 名前の区切りとして扱う文字
+NAME_SEPARATOR = re.compile(r'[\s・&＆]+')
+KCAL_PATTERN = re.compile(r'([\d.]+)\s*kcal')
+
+def split_list(value: str | None) -> list[str]:
+    if not value:
+        return []
+    items = []
+    for v in value.split(","):
+        v = v.strip().removesuffix("アレルギー")
+        if v and v != "なし":
+            items.append(v)
+    return items
+
+def parse_kcal(nutrition: dict) -> float | None:
+    m = KCAL_PATTERN.search(nutrition.get("熱量", ""))
+    return float(m.group(1)) if m else None
+
+def menu_to_item(menu: Menu) -> dict:
+    nutrition = json.loads(menu.nutrition) if menu.nutrition else {}
+    return {
+        "id": menu.id,
+        "name": menu.name,
+        "category": menu.category or "dish",
+        "description": menu.description or "",
+        "ingredients": split_list(menu.ingredients),
+        "allergies": split_list(menu.allergies),
+        "is_halal": bool(menu.is_halal),
+        "nutrition": nutrition,
+        "kcal": parse_kcal(nutrition),
+    }
+
+def name_keywords(name: str) -> list[str]:
+    """商品名と、その区切られた各部分(2文字以上の日本語か4文字以上の英字)を検索語にする"""
+    keywords = [name]
+    for part in NAME_SEPARATOR.split(name):
+        if part != name and (len(part) >= 4 or (len(part) >= 2 and not part.isascii())):
+            keywords.append(part)
+    return keywords
+
+class Catalog:
+    """
+    Menuテーブルをメモリ上に読み込み、ID・商品名・アレルギー物質・原材料で引けるようにする。
+    一定間隔でテーブルの件数と最終更新日時を確認し、変わっていれば読み込み直す。
+    """
+    def __init__(self, refresh_seconds: float = CATALOG_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.version = 0
+        # メニューの内容から作る値。ワーカー間で同じになり、応答キャッシュのキーに含める
+        self.digest = ""
+        self.items: dict[str, dict] = {}
+        self.cards: dict[str, dict] = {}
+        self.by_keyword: dict[str, set[str]] = {}
+        self.by_allergen: dict[str, set[str]] = {}
+        self.by_ingredient: dict[str, set[str]] = {}
+        self._signature = None
+        self._checked_at = 0.0
+        self._keyword_pattern: re.Pattern | None = None
+        # 読み込み直した後に呼ぶ関数
+        self.on_reload: list = []
+
+    def invalidate(self):
+        self._checked_at = 0.0
+        self._signature = None
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._checked_at >= self.refresh_seconds
+
+    def ensure_fresh(self, db: Session):
+        if not self.is_stale():
+            return
+        self._checked_at = time.monotonic()
+        signature = tuple(db.query(func.count(Menu.id), func.max(Menu.updated_at)).one())
+        if signature != self._signature:
+            self.load(db.query(Menu).order_by(Menu.id).all())
+            self._signature = signature
+
+    def load(self, menus: list[Menu]):
+        items = {}
+        by_keyword: dict[str, set[str]] = {}
+        by_allergen: dict[str, set[str]] = {}
+        by_ingredient: dict[str, set[str]] = {}
+        for menu in menus:
+            item = menu_to_item(menu)
+            items[item["id"]] = item
+            for keyword in name_keywords(item["name"]) + [item["id"]]:
+                by_keyword.setdefault(keyword.lower(), set()).add(item["id"])
+            for allergen in item["allergies"]:
+                by_allergen.setdefault(allergen, set()).add(item["id"])
+            for ingredient in item["ingredients"]:
+                by_ingredient.setdefault(ingredient, set()).add(item["id"])
+        # 商品名の一部(「カルピス」など)は、区切られていない商品名(「カルピスウォーター」)にも含まれていれば引けるようにする
+        for keyword, ids in by_keyword.items():
+            for item in items.values():
+                if keyword in item["name"].lower():
+                    ids.add(item["id"])
+
+        terms = list(by_keyword) + list(by_allergen) + list(by_ingredient)
+        # 長い語を優先して一度の走査で照合する
+        terms.sort(key=len, reverse=True)
+        self._keyword_pattern = re.compile("|".join(re.escape(t) for t in terms)) if terms else None
+        self.items = items
+        self.cards = {
+            item["id"]: {"id": item["id"], "name": item["name"], "allergies": item["allergies"], "kcal": item["kcal"]}
+            for item in items.values()
+        }
+        self.by_keyword = by_keyword
+        self.by_allergen = by_allergen
+        self.by_ingredient = by_ingredient
+        self.digest = hashlib.sha256(
+            json.dumps([items[item_id] for item_id in sorted(items)], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        self.version += 1
+        for callback in self.on_reload:
+            callback()
+
+    def get(self, item_id: str) -> dict | None:
+        return self.items.get(item_id)
+
+    def card(self, item_id: str) -> dict | None:
+        """ストリームで送る商品カード"""
+        return self.cards.get(item_id)
+
+    def find_items(self, text: str) -> list[dict]:
+        """メッセージに商品名またはIDが含まれるメニューを返す"""
+        if self._keyword_pattern is None:
+            return []
+        found: dict[str, None] = {}
+        for m in self._keyword_pattern.finditer(text.lower()):
+            for item_id in sorted(self.by_keyword.get(m.group(), ())):
+                found[item_id] = None
+        return [self.items[item_id] for item_id in found]
+
+    def search(self, text: str, limit: int = CATALOG_MAX_ITEMS) -> list[dict]:
+        """メッセージに含まれる商品名・ID・アレルギー物質・原材料に関係するメニューを返す"""
+        if self._keyword_pattern is None:
+            return []
+        found: dict[str, None] = {}
+        for m in self._keyword_pattern.finditer(text.lower()):
+            term = m.group()
+            for index in (self.by_keyword, self.by_allergen, self.by_ingredient):
+                for item_id in sorted(index.get(term, ())):
+                    found[item_id] = None
+        return [self.items[item_id] for item_id in list(found)[:limit]]
+
+    def render_index(self) -> str:
+        """
+        代表的なメニューの簡潔な一覧。IDの順に最大CATALOG_MAX_LISTED件を並べ、カタログが変わらない限り同じ文字列になる。
+        毎ターン送るため全商品は載せず、提供しているかどうかは「### メニューデータ」で判断させる。
+        """
+        data = [
+            {"id": item["id"], "商品名": item["name"], "特徴": item["description"].split("。")[0]}
+            for item in sorted(self.items.values(), key=lambda item: item["id"])[:CATALOG_MAX_LISTED]
+        ]
+        return "### メニュー一覧\n" + json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    def render(self, text: str) -> str | None:
+        """質問に関係するメニューの詳しいデータを作る。関係するメニューがなければNoneを返す"""
+        items = self.search(text)
+        if not items:
+            return None
+        data = []
+        for item in items:
+            entry = {
+                "id": item["id"],
+                "商品名": item["name"],
+                "特徴": item["description"],
+                "原材料": item["ingredients"],
+                "アレルギー物質": item["allergies"],
+                "栄養成分表示": item["nutrition"],
+            }
+            # is_halalがFalseの場合は「未確認」のため載せない
+            if item["is_halal"]:
+                entry["ハラール"] = True
+            data.append(entry)
+        return "### メニューデータ\n" + json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+catalog = Catalog()
@@ -1,442 +1,350 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Header, Request
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-import uuid
+import asyncio
 import json
+import logging
 import re
-from openai import OpenAI
-from datetime import datetime
-from db import  get_db, Chat, Message
+import time
+from typing import AsyncIterator
+from db import  run_db, Chat
+from persistence import message_writer
 from model import ChatMessageInput
-from config import OPENAI_API_KEY
+from llm import in_flight, stream_openai
+from prompt import LEGACY_SEED_COUNT, current_template_id, load_template_messages
+from history import ChatHistory, history_cache, load_history
+from context import count_tokens
+from catalog import catalog
+from fastpath import FastPath
+from payload import payload_builder
+from cache import cache_key, response_cache
+from config import RESPONSE_CACHE_MAX_TURNS
+from admission import chat_locks, chat_rate_limiter, client_key, governor, rate_limiter
+from idempotency import Turn, turn_store
+from metrics import Profile, COMPLETION_TOKENS, PROMPT_TOKENS, REPLIES, IDEMPOTENT_REPLAYS
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+fast_path = FastPath(catalog)
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+def stream_json_res(obj: any) -> str:
+    return f"{json.dumps(obj, ensure_ascii=False)}\n"
+
+class SentenceSplitter:
+    """
+    ストリーミングで届くテキストを文単位に区切る。
+    終端記号が届くまでは途中の文をバッファに保持する。
+    """
+    pattern = re.compile(r'[^。!?！？]*[。!?！？]')
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, text: str) -> list[str]:
+        self.buffer += text
+        sentences = []
+        end = 0
+        for m in self.pattern.finditer(self.buffer):
+            sentences.append(m.group())
+            end = m.end()
+        self.buffer = self.buffer[end:]
+        return sentences
+
+    def flush(self) -> list[str]:
+        rest, self.buffer = self.buffer, ''
+        return [rest] if rest else []
+
+class TagExtractor:
+    """
+    モデルが回答に付ける商品IDのタグ([jasmine]など)をストリームから取り除く。
+    タグがチャンクの境界で分かれても検出できるよう、閉じていない「[」以降はバッファに保持する。
+    カタログにないIDのタグは本文として残す。
+    """
+    pattern = re.compile(r'\[([a-z0-9][a-z0-9-]*)\]')
+    partial = re.compile(r'\[[a-z0-9-]*$')
+    # これより長い「[」以降はタグではないとみなす
+    max_tag_length = 64
+
+    def __init__(self, known_ids):
+        self.known_ids = known_ids
+        self.buffer = ''
+
+    def _strip(self, text: str, ids: list[str]) -> str:
+        def replace(m):
+            if m.group(1) in self.known_ids:
+                ids.append(m.group(1))
+                return ''
+            return m.group()
+        return self.pattern.sub(replace, text)
+
+    def feed(self, text: str) -> tuple[str, list[str]]:
+        self.buffer += text
+        ids = []
+        m = self.partial.search(self.buffer)
+        if m and len(self.buffer) - m.start() <= self.max_tag_length:
+            ready, self.buffer = self.buffer[:m.start()], self.buffer[m.start():]
+        else:
+            ready, self.buffer = self.buffer, ''
+        return self._strip(ready, ids), ids
+
+    def flush(self) -> tuple[str, list[str]]:
+        ids = []
+        rest, self.buffer = self.buffer, ''
+        return self._strip(rest, ids), ids
 
 def split_sentence(content: str):
-    pattern = r'([。!?！？])'
-    parts = re.split(pattern, content)
-    sentences = []
-    current_sentence = ''
-    for part in parts:
-        current_sentence += part
-        if re.match(pattern, part):
-            sentences.append(current_sentence)
-            current_sentence = ''
-    if current_sentence:
-        sentences.append(current_sentence)
-    return sentences
+    splitter = SentenceSplitter()
+    return splitter.feed(content) + splitter.flush()
 
-def stream_json_res(obj: any) -> str:
-    return f"{json.dumps(obj, ensure_ascii=False)}\n"
+class ChatStreamingResponse(StreamingResponse):
+    """送信を終えるか中断されたときに、ターンのために確保したロックやスロットを解放する"""
+    def __init__(self, content, releases: list, **kwargs):
+        super().__init__(content, **kwargs)
+        self.releases = releases
 
-async def chat_stream(response_text: str, chat_id: str, db: Session):
-    splited_content = split_sentence(response_text)
-    full_content = response_text
-    for sentence in splited_content:
-        yield stream_json_res({'content': sentence})
-    db_message = Message(chat_id=chat_id, role="assistant", content=full_content)
-    db.add(db_message)
-    db.commit()
-    yield stream_json_res({'status': 'finished'})
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            for release in self.releases:
+                release()
 
-@router.post("/start_chat")
-async def start_chat(db: Session = Depends(get_db)):
-    id = str(uuid.uuid4())
-    db_chat = Chat(id=id)
+async def iter_text(text: str):
+    yield text
+
+async def prefetch(deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    最初の差分が届くまで待ち、それを先頭に戻したストリームを返す。
+    応答を始める前に上流が失敗した場合は、空の200ではなく502を返す。
+    """
+    try:
+        first = await anext(deltas)
+    except StopAsyncIteration:
+        return iter_text("")
+    except Exception as e:
+        logger.exception("LLM stream failed before the first token")
+        await deltas.aclose()
+        raise HTTPException(status_code=502, detail="LLM provider error") from e
+
+    async def chained():
+        try:
+            yield first
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+    return chained()
+
+def create_chat(db: Session, template_id: str) -> str:
+    db_chat = Chat(prompt_template_id=template_id)
     db.add(db_chat)
-    db_messages = [Message(
-        chat_id=db_chat.id,
-        role="system",
-        content=(
-            """
-            あなたはレストランの飲料説明やおすすめを行うチャットボットです。以下のガイドラインに従って回答してください。
-
-            ### 基本的な指示
-            1. **提供形式**:
-                - 飲み物はアイスのみの提供とします。ホット飲料のリクエストには「当店ではアイスのみの提供となっております」と回答してください。
-            2. **存在しないメニューへの対応**:
-                - 存在しないメニューについて質問された場合は、「申し訳ございませんが、そのメニューは当店では提供しておりません」と返答してください。
-            3. **アレルギー情報の提供**:
-                - 顧客からのアレルギーに関する質問には、各飲料のアレルギー情報を基に回答してください。
-            4. **栄養成分の説明**:
-                - 顧客が栄養成分について尋ねた場合、該当する飲料の栄養成分を提供してください。
-            5. **おすすめの提案**:
-                - 顧客の好みや質問内容に基づいて、最適な飲料をおすすめしてください。
-            6. **IDの併記**:
-                - 回答に具体的な商品名が含まれる際は、商品に対応するIDも併記してください。 例：「ジャスミン茶がおすすめです。[jasmine]」
-
-            ### 飲料データ
-            ```json
-            {
-                "beverages": [
-                    {
-                        "id": "jasmine",
-                        "商品名": "ジャスミン茶",
-                        "特徴": "最高級茶葉「銀毫（ぎんごう）」を30%使用したジャスミン茶です。ジャスミンの爽やかな香りが特徴です。",
-                        "アレルギー物質": "なし",
-                        "栄養成分表示": {
-                            "熱量": "0kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "0g",
-                            "食塩相当量": "0.02g"
-                        }
-
-                    },
-                    {
-                        "id": "dodecamine",
-                        "商品名": "ドデカミン",
-                        "特徴": "爽快な炭酸と豊かなミネラルが特徴のスポーツドリンク。12種類の元気成分と強炭酸の刺激で疲れた気分を吹き飛ばし気分が弾けるエナジー炭酸飲料。",
-                        "アレルギー物質": "なし",
-                        "栄養成分表示": {
-                            "熱量": "19kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "4.7g",
-                            "食塩相当量": "0.1g"
-                        }
-                    },
-                    {
-                        "id": "coca-cola",
-                        "商品名": "コカ・コーラ",
-                        "特徴": "世界中で愛される定番炭酸飲料。深みのあるコーラ風味とシュワシュワの炭酸が絶妙にマッチし、どんな食事にもよく合います。リフレッシュしたい時にぴったりの一杯です。",
-                        "アレルギー物質": "なし",
-                        "栄養成分表示": {
-                            "熱量": "45kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "11.3g",
-                            "食塩相当量": "0g"
-                        }
-                    },
-                    {
-                        "id": "mascotto",
-                        "商品名": "マスカットウォーター",
-                        "特徴": "すっきりとした果実感が感じられる、低カロリーなマスカットウォーター。午後の一休みにぴったりな爽やかな味わいです。",
-                        "アレルギー物質": "なし",
-                        "栄養成分表示": {
-                            "熱量": "13kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "3.2g",
-                            "食塩相当量": "0g"
-                        }
-                    },
-                    {
-                        "id": "calpis-water",
-                        "商品名": "カルピスウォーター",
-                        "特徴": "すっきり爽やかな味わい、純水でおいしく作ったカルピスです。乳酸菌と酵母、発酵という自然製法が生みだす甘ずっぱいおいしさ。子供から大人まで幅広く楽しめます。",
-                        "アレルギー物質": ["乳", "大豆"],
-                        "栄養成分表示": {
-                            "熱量": "46kcal",
-                            "たんぱく質": "0.3g",
-                            "脂質": "0g",
-                            "炭水化物": "11g",
-                            "食塩相当量": "0.04g"
-                        }
-                    },
-                    {
-                        "id": "calpis-rich",
-                        "商品名": "カルピス THE RICH 冬仕込み",
-                        "特徴": "冬限定のまろやかな濃さ。乳原料をリッチに使用したカルピスに北海道産ミルクと、ミルクソースを加えました。一休みしたい時など、自分を甘やかしてあげたい時にぴったりな、冬限定のまろやかな濃さが楽しめます。",
-                        "アレルギー物質": ["乳", "大豆"],
-                        "栄養成分表示": {
-                            "熱量": "52kcal",
-                            "たんぱく質": "0.5g",
-                            "脂質": "0g",
-                            "炭水化物": "13g",
-                            "食塩相当量": "0.12g"
-                        }
-                    },
-                    {
-                        "id": "peach-calpis",
-                        "商品名": "フルボディピーチ&カルピス",
-                        "特徴": "重みのある桃の濃さとカルピスの甘ずっぱさが織りなすおいしさ。まるでワインのテイスティングのようにひと口目にワクワクを感じつつ、ボディ感のある桃の濃さとカルピスのやさしさをお楽しみいただけます",
-                        "アレルギー物質": ["乳", "大豆", "もも"],
-                        "栄養成分表示": {
-                            "熱量": "29kcal",
-                            "たんぱく質": "0.3g",
-                            "脂質": "0g",
-                            "炭水化物": "6.9g",
-                            "食塩相当量": "0.08g"
-                        }
-                    },
-                    {
-                        "id": "coffee",
-                        "商品名": "ブラックコーヒー",
-                        "特徴": "香りひろがる、心地よいコク。深煎り豆を丁寧に抽出した奥深い味わい。挽きたて豆と淹れたて時のような香りが楽しめるブラックコーヒーです。",
-                        "アレルギー物質": [],
-                        "栄養成分表示": {
-                            "熱量": "0kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "0.6g",
-                            "食塩相当量": "0.05g"
-                        }
-                    },
-                    {
-                        "id": "ayataka",
-                        "商品名": "綾鷹",
-                        "特徴": "豊かなうまみとかろやかな後味。今の時代にあわせて、茶師と協働して仕上げた「まるで淹れたて一杯目のおいしさ」です。旨みはしっかり本格、なのに後味は軽やかな味わい。",
-                        "アレルギー物質": [],
-                        "栄養成分表示": {
-                            "熱量": "0kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "0g",
-                            "食塩相当量": "0.02g"
-                        }
-                    },
-                    {
-                        "id": "fanta-orange",
-                        "商品名": "ファンタ オレンジ",
-                        "特徴": "爽やかなオレンジ風味が楽しめる炭酸飲料。オレンジの風味がしっかりと感じられ、よりキリっとした軽やかな後味をお楽しみいただけます。子供から大人まで幅広く愛される定番の味わいです。",
-                        "アレルギー物質": ["オレンジ"],
-                        "栄養成分表示": {
-                            "熱量": "44kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "11g",
-                            "食塩相当量": "0.01g"
-                        }
-                    },
-                    {
-                        "id": "mugi",
-                        "商品名": "むぎ茶",
-                        "特徴": "香ばしい麦の風味が特徴のむぎ茶。焙煎の異なる3種類の六条大麦を使用しています。カフェインレスなので小さなお子様や妊娠中の方でも安心してお飲み頂けます。",
-                        "アレルギー物質": [],
-                        "栄養成分表示": {
-                            "熱量": "0kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "0g",
-                            "食塩相当量": "0g"
-                        }
-                    },
-                    {
-                        "id": "black-oolong",
-                        "商品名": "黒烏龍茶",
-                        "特徴": "脂肪の吸収を抑え、体に脂肪がつきにくくなる特定保健用食品のウーロン茶です。独自製法でカフェイン量を抑えた他、苦味も少なく、飲みやすい味わいで、食事によく合い、無理なく毎日飲み続けられるさっぱりとした後味に仕上げました。",
-                        "アレルギー物質": [],
-                        "栄養成分表示": {
-                            "熱量": "0kcal",
-                            "たんぱく質": "0g",
-                            "脂質": "0g",
-                            "炭水化物": "0g",
-                            "食塩相当量": "0g"
-                        }
-                    }
-                ]
-            }"""
-        ),
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""「カルピス THE RICH 冬仕込み」は通常のカルピスとどう違いますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""北海道産ミルクとミルクソースが加わったことにより、より濃くてまろやかな味わいが楽しめます。""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""特に飲みたいものが決まっていないんですが、おすすめの飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""定番の「コカ・コーラ」や、幅広い世代に人気の「カルピスウォーター」はいかがでしょうか。好みの味や今の気分を教えていただければ、それに合わせた飲み物をおすすめできます。[coca-cola][calpis-water]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""甘いものが飲みたいです。""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""甘い飲み物では「コカ・コーラ」が人気です。もう少し甘さ控えめなものや、フルーティーなものがお好きであればおっしゃってください。[coca-cola]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""冬にぴったりの飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""期間限定の「カルピス THE RICH 冬仕込み」や「フルボディピーチ&カルピス」がおすすめです。[calpis-rich][peach-calpis]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""料理に合う飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""飲みやすい味わいの「黒烏龍茶」や、定番の「コカ・コーラ」などはいかがでしょうか。[black-oolong][coca-cola]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""元気が出る飲み物がほしいです。""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""エネルギーをチャージしたい時は、ガラナ・マカ・アルギニンなどの成分が配合された「ドデカミン」が最適です。[dodecamine]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""爽快感のある飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""「ファンタ オレンジ」のキリッとした味わいと、炭酸の爽快感を味わうのはいかがでしょうか。[fanta-orange]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""何か落ち着ける飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""もしゆっくりしたい気分でしたら、「綾鷹」や「ブラックコーヒー」で一息つくのはいかがでしょうか？[ayataka][coffee]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""リラックスできる飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""もしリラックスしたい気分でしたら、「ジャスミン茶」の心地よい香りはいかがでしょうか。[jasmine]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""ダイエット中におすすめの飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""「黒烏龍茶」は脂肪の吸収を抑える効果があるため、ダイエット中におすすめです。[black-oolong]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""健康にいい飲み物はありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""カフェインレスの「むぎ茶」や、特定保健用食品の「黒烏龍茶」がおすすめです。[mugi][black-oolong]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""甘すぎないジュースが飲みたいです。""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""すっきりとした果実感が感じられる「マスカットウォーター」や、ちょうどいい甘酸っぱさの「カルピスウォーター」がおすすめです。[mascotto][calpis-water]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""さっぱりした雰囲気のものはありますか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""さっぱりとした味わいがお好きでしたら、爽やかな香りが特徴の「ジャスミン茶」や、すっきりとした味わいの「マスカットウォーター」はいかがでしょうか？[jasmine][mascotto]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""ヘルシーな飲み物はなんですか？""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""お茶類全般は低カロリーなのでおすすめです。カフェインを気にされなければ、「ブラックコーヒー」も低カロリーですよ。[coffee]""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="user",
-        content="""果物系の飲み物が飲みたいです。""",
-        created_at=datetime.now()
-    ),
-    Message(
-        chat_id=db_chat.id,
-        role="assistant",
-        content="""しっかり桃を感じられる「フルボディピーチ&カルピス」や、マスカットの果実感が楽しめる「マスカットウォーター」がおすすめです。[peach-calpis][mascotto]""",
-        created_at=datetime.now()
-    )]
-    for m in db_messages:
-        db.add(m)
     db.commit()
+    return db_chat.id
 
-    return {"chat_id": id}
+async def chat_stream(deltas: AsyncIterator[str], chat_id: str, profile: Profile | None = None, source: str = "llm", indexed: bool = False):
+    """indexedがTrueの場合は、再送時に途中から再開できるよう各イベントに通し番号(index)を付ける"""
+    profile = profile or Profile()
+    splitter = SentenceSplitter()
+    tags = TagExtractor(catalog.cards)
+    sent_products = set()
+    count = 0
+
+    def emit(obj: dict) -> str:
+        nonlocal count
+        if indexed:
+            obj = {'index': count, **obj}
+        count += 1
+        return stream_json_res(obj)
 
-def call_openai(messages, db: Session):
-    response = client.chat.completions.create(model="gpt-4o",
-    messages=messages,)
+    def events(text: str, ids: list[str], final: bool = False):
+        for sentence in splitter.feed(text) + (splitter.flush() if final else []):
+            if sentence.strip():
+                yield emit({'content': sentence})
+        products = []
+        for item_id in ids:
+            if item_id not in sent_products:
+                sent_products.add(item_id)
+                products.append(catalog.card(item_id))
+        if products:
+            yield emit({'products': products})
 
-    return response.choices[0].message.content.strip()
+    chunks = []
+    started = time.perf_counter()
+    split_seconds = 0.0
+    failed = False
+    try:
+        async for delta in deltas:
+            chunks.append(delta)
+            split_started = time.perf_counter()
+            output = list(events(*tags.feed(delta)))
+            split_seconds += time.perf_counter() - split_started
+            for event in output:
+                yield event
+    except Exception:
+        # 応答の途中で上流が失敗した場合は、送った部分までを回答として保存してエラーを伝える
+        logger.exception("chat %s: reply stream failed", chat_id)
+        failed = True
+    for event in events(*tags.flush(), final=True):
+        yield event
+    profile.record("split", split_seconds)
+    profile.record("generate", time.perf_counter() - started)
+    full_content = ''.join(chunks).strip()
+    if full_content:
+        with profile.span("persist_assistant"):
+            await message_writer.write(chat_id, "assistant", full_content)
+        history_cache.append(chat_id, "assistant", full_content)
+    if failed:
+        yield emit({'status': 'error'})
+        return
+    REPLIES.inc(source=source)
+    if source == "llm":
+        COMPLETION_TOKENS.observe(count_tokens(full_content))
+    if profile.enabled:
+        yield emit({'profile': profile.breakdown()})
+    yield emit({'status': 'finished'})
+
+@router.post("/start_chat")
+async def start_chat():
+    profile = Profile()
+    with profile.span("template"):
+        template_id = await current_template_id()
+    with profile.span("create_chat"):
+        id = await run_db(create_chat, template_id)
+    history_cache.put(id, ChatHistory(template_id, []))
+
+    return {"chat_id": id}
 
 @router.post("/chat/{chat_id}")
-async def chat_endpoint(chat_id: str, message: ChatMessageInput, db: Session = Depends(get_db)):
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
+async def chat_endpoint(
+    chat_id: str,
+    message: ChatMessageInput,
+    request: Request,
+    x_profile: str | None = Header(default=None),
+    idempotency_key: str | None = Header(default=None),
+    x_resume_from: int = Header(default=0),
+):
+    """
+    Idempotency-Keyを付けたターンは接続が切れても最後まで生成して保存する。
+    同じキーで再送すると、モデルを呼び直さずX-Resume-From番目のイベントから応答を返す。
+    """
+    # X-Profile: 1 のリクエストは、最後に段階ごとの所要時間を返す
+    profile = Profile(enabled=x_profile == "1")
 
-    db_user_message = Message(chat_id=chat_id, role="user", content=message.content)
-    db.add(db_user_message)
-    db.commit()
+    turn = None
+    if idempotency_key:
+        turn, created = turn_store.claim(chat_id, idempotency_key, message.content)
+        if not created:
+            # 最初のリクエストが断られた場合は同じ例外を返す
+            await asyncio.shield(turn.started)
+            IDEMPOTENT_REPLAYS.inc()
+            return StreamingResponse(turn.replay(x_resume_from), media_type="text/event-stream", headers=turn.headers)
+
+    try:
+        # 再送は新しいターンを作らないため、レート制限は新しく作ったターンだけに掛ける
+        # 同じNATの内側にある端末を1つにまとめないよう、アドレスごとの上限は緩くし、チャットごとにも制限する
+        rate_limiter.check(client_key(request))
+        chat_rate_limiter.check(chat_id)
+        with profile.span("history"):
+            history = await load_history(chat_id)
+        if history is None:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        # 同じチャットのターンが重ならないよう、応答を送り終えるまでロックを持つ
+        with profile.span("chat_lock"):
+            await chat_locks.acquire(chat_id)
+    except BaseException as e:
+        if turn is not None:
+            turn_store.fail(chat_id, idempotency_key, turn, e)
+        raise
+    releases = [lambda: chat_locks.release(chat_id)]
+    try:
+        return await chat_turn(chat_id, message.content, history, profile, releases, idempotency_key, turn, x_resume_from)
+    except BaseException as e:
+        if turn is not None:
+            turn_store.fail(chat_id, idempotency_key, turn, e)
+        for release in releases:
+            release()
+        raise
+
+async def chat_turn(
+    chat_id: str,
+    content: str,
+    history: ChatHistory,
+    profile: Profile,
+    releases: list,
+    idempotency_key: str | None = None,
+    turn: Turn | None = None,
+    resume_from: int = 0,
+):
+    user_message = {"role": "user", "content": content}
+
+    async def persist_user_message():
+        with profile.span("persist_user"):
+            await message_writer.write(chat_id, "user", content)
+        history.messages.append(user_message)
+
+    def respond(deltas, source: str, headers: dict | None = None):
+        events = chat_stream(deltas, chat_id, profile, source, indexed=turn is not None)
+        if turn is None:
+            return ChatStreamingResponse(events, releases, media_type="text/event-stream", headers=headers)
+        # 生成は接続から切り離し、ロックとスロットは生成が終わったときに解放する
+        turn_store.start(chat_id, idempotency_key, turn, events, releases, headers)
+        return StreamingResponse(turn.replay(resume_from), media_type="text/event-stream", headers=headers)
+
+    with profile.span("catalog"):
+        if catalog.is_stale():
+            await run_db(catalog.ensure_fresh)
+    with profile.span("fastpath"):
+        answer = fast_path.answer(content)
+    if answer is not None:
+        await persist_user_message()
+        return respond(iter_text(answer), "fastpath")
+
+    with profile.span("context"):
+        if history.prompt_template_id:
+            template_id = history.prompt_template_id
+            turns = history.messages + [user_message]
+        else:
+            # 旧形式のチャットも保存済みのシード行ではなく現行のテンプレートから共通のプレフィックスを作る
+            template_id = await current_template_id()
+            turns = history.messages[LEGACY_SEED_COUNT:] + [user_message]
+        template = await load_template_messages(template_id)
+        messages, prompt_tokens = payload_builder.build(chat_id, template_id, template, turns)
+
+    headers = {}
+    key = None
+    # キャッシュが無効な場合はX-Cacheを付けず、負荷試験でキャッシュを引いたターンと区別できるようにする
+    if response_cache.backend is not None and sum(1 for m in turns if m["role"] == "user") <= RESPONSE_CACHE_MAX_TURNS:
+        with profile.span("cache"):
+            key = cache_key(messages, catalog.digest)
+            cached = await response_cache.get(key)
+        if cached is not None:
+            # キャッシュから返す場合はモデルにプロンプトを送らない
+            await persist_user_message()
+            headers["X-Cache"] = "hit"
+            headers["X-Prompt-Tokens"] = "0"
+            return respond(iter_text(cached), "cache", headers)
+        headers["X-Cache"] = "miss"
+
+    # LLMの空きを待つ。断られた場合や最初のトークンの前に失敗した場合はユーザーの発話も保存しない。
+    # 同じペイロードの補完が進行中であれば上流に新たに送らないため、スロットを使わずに相乗りする
+    if not in_flight(messages):
+        with profile.span("admission"):
+            acquired_at = await governor.acquire()
+        releases.append(lambda: governor.release(acquired_at))
+
+    deltas = stream_openai(messages)
+    if key is not None:
+        deltas = response_cache.record(key, deltas)
+    with profile.span("first_token"):
+        deltas = await prefetch(deltas)
+    await persist_user_message()
+    PROMPT_TOKENS.observe(prompt_tokens)
+    headers["X-Prompt-Tokens"] = str(prompt_tokens)
+    logger.info("chat %s: %d prompt tokens", chat_id, prompt_tokens)
 
-    chat_messages = db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.created_at).all()
-    messages = [{"role": m.role, "content": m.content} for m in chat_messages]
+    return respond(deltas, "llm", headers)
 
-    response_text = call_openai(messages, db)
-    return StreamingResponse(chat_stream(response_text, chat_id, db), media_type="text/event-stream")
+@router.get("/cache/stats")
+async def cache_stats():
+    return response_cache.stats()
@@ -3,8 +3,114 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# openai: OpenAI API, fake: 負荷試験用のローカルな代役
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
+
+# openaiプロバイダを最初に使うときに確認する
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise ValueError("OPENAI_API_KEY is not set in the environment variables")
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./chat_history.db"
\ No newline at end of file
+# PostgreSQLは postgresql+psycopg://... (poetry install -E postgres)
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chat_history.db")
+# 非同期ドライバのURL(未指定ならSQLALCHEMY_DATABASE_URLから aiosqlite / asyncpg を使うURLを組み立てる。
+# ドライバは poetry install -E sqlite / -E postgres で入る)
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+# コネクションプール(SQLite以外)。ワーカーあたりの最大接続数は DB_POOL_SIZE + DB_MAX_OVERFLOW
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# 非同期エンジンを使う場合に、同期エンジン(エクスポートや整理)に割り当てる接続数。残りを非同期エンジンが使う
+DB_SYNC_POOL_SIZE = int(os.getenv("DB_SYNC_POOL_SIZE", "2"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# SQLiteでロックの解放を待つ時間(ミリ秒)
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+# 上流LLMへのリクエストのタイムアウト（秒）
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# ワーカーあたりの同時接続数
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "500"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "100"))
+# fakeプロバイダの最初のトークンまでの時間(秒)と、1秒あたりのトークン数
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5"))
+FAKE_LLM_TOKEN_RATE = float(os.getenv("FAKE_LLM_TOKEN_RATE", "50"))
+
+# ワーカー内で履歴を保持するチャット数(0で無効)
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "2048"))
+# キャッシュした履歴をターンごとにDBのメッセージ数と照合する。
+# 同じチャットが常に同じワーカーに届く(ワーカーが1つ、またはセッションアフィニティがある)場合だけ0にしてよい
+HISTORY_CACHE_REVALIDATE = os.getenv("HISTORY_CACHE_REVALIDATE", "1") == "1"
+
+# 1リクエストあたりのプロンプトのトークン上限(システムプロンプトを含む)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "16000"))
+# 要約せずにそのまま送る直近のメッセージ数の下限
+CONTEXT_MIN_RECENT_MESSAGES = int(os.getenv("CONTEXT_MIN_RECENT_MESSAGES", "4"))
+# 古い会話の要約に使うモデル
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+
+# メニューの変更を確認する間隔(秒)
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "30"))
+# 1ターンでプロンプトに含めるメニューの上限
+CATALOG_MAX_ITEMS = int(os.getenv("CATALOG_MAX_ITEMS", "8"))
+# 毎ターン送るメニュー一覧に載せる商品数の上限
+CATALOG_MAX_LISTED = int(os.getenv("CATALOG_MAX_LISTED", "30"))
+
+# 応答キャッシュ: memory(ワーカー内), sqlite(ワーカー間で共有), none(無効)
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "./response_cache.db")
+# この数以下のユーザー発話を含む会話だけをキャッシュする
+RESPONSE_CACHE_MAX_TURNS = int(os.getenv("RESPONSE_CACHE_MAX_TURNS", "1"))
+
+# メッセージの書き込みキュー
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+# キューに溜まったメッセージをコミットするまでの最大待ち時間(秒)
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.05"))
+
+# 1ターンで使うfew-shotの例の数と、そのトークン上限
+FEWSHOT_K = int(os.getenv("FEWSHOT_K", "3"))
+FEWSHOT_TOKEN_BUDGET = int(os.getenv("FEWSHOT_TOKEN_BUDGET", "400"))
+# すべてのチャットで共通のプレフィックスに含める、先頭から数えたfew-shotの例の数
+FEWSHOT_STATIC = int(os.getenv("FEWSHOT_STATIC", "2"))
+
+# ワーカーあたりのLLM呼び出しの同時実行数と、空きを待てるリクエスト数
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "256"))
+# これ以上待たせる見込みのリクエストはすぐに断る(秒)
+ADMISSION_DEADLINE = float(os.getenv("ADMISSION_DEADLINE", "10"))
+# クライアント(IPアドレス)ごとのチャットの送信回数の上限。
+# 店内の端末は同じNATの内側から送るため、1台分よりも大きくする
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "120"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "30"))
+# チャット(端末)ごとの送信回数の上限
+CHAT_RATE_LIMIT_PER_MINUTE = float(os.getenv("CHAT_RATE_LIMIT_PER_MINUTE", "20"))
+CHAT_RATE_LIMIT_BURST = int(os.getenv("CHAT_RATE_LIMIT_BURST", "5"))
+# 前段にあるリバースプロキシの数。0ならX-Forwarded-Forを信用せず接続元のアドレスを使う
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+# 転送ヘッダを信用する接続元のアドレス(カンマ区切りのCIDR)。それ以外から直接届いた接続は接続元のアドレスを使う
+TRUSTED_PROXIES = [cidr.strip() for cidr in os.getenv("TRUSTED_PROXIES", "127.0.0.0/8,::1/128").split(",") if cidr.strip()]
+# 前段のプロキシがクライアントのアドレスを入れるヘッダ(CloudflareならCF-Connecting-IP)。
+# TRUSTED_PROXY_HOPSが1以上のときだけ使い、X-Forwarded-Forより優先する
+CLIENT_IP_HEADER = os.getenv("CLIENT_IP_HEADER")
+
+# 会話履歴APIの1ページの件数(既定値と上限)と、エクスポートでDBから一度に取り出す行数
+MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", "50"))
+MESSAGES_PAGE_MAX = int(os.getenv("MESSAGES_PAGE_MAX", "200"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# エクスポートなど管理用APIのBearerトークン(未設定なら管理用APIは無効)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# 最後のメッセージからこの日数が経ったチャットをアーカイブしてDBから削除する(0で無効)
+CHAT_RETENTION_DAYS = float(os.getenv("CHAT_RETENTION_DAYS", "90"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+# メンテナンスの実行間隔(秒、0で無効)と、1トランザクションで扱うチャット数、バッチ間の待ち時間(秒)
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "20"))
+MAINTENANCE_PAUSE = float(os.getenv("MAINTENANCE_PAUSE", "0.05"))
+# SQLiteのincremental_vacuumで1回に解放するページ数
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "256"))
+
+# Idempotency-Keyを付けたターンの応答を再送用に保持する時間(秒)と件数の上限
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_MAX_TURNS = int(os.getenv("IDEMPOTENCY_MAX_TURNS", "10000"))
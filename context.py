@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from config import OPENAI_MODEL, CONTEXT_TOKEN_BUDGET, CONTEXT_MIN_RECENT_MESSAGES, SUMMARY_MODEL, HISTORY_CACHE_SIZE
+from llm import call_openai
+from admission import governor
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# メッセージごとの書式分のトークン数と、応答の開始に使われるトークン数
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+SUMMARY_PROMPT = """以下はレストランの飲料案内チャットボットと顧客の会話です。
+顧客の好み、アレルギーや体調に関する申告、すでにおすすめした商品とそのIDを中心に、今後の応答に必要な情報だけを日本語で簡潔に要約してください。"""
+
+# 読み込めなかった場合はFalse
+_encoding = None
+
+def _get_encoding():
+    """
+    tiktokenのエンコーディング。初回はファイルをダウンロードするため(TIKTOKEN_CACHE_DIRに保存される)、
+    オフラインで読み込めない場合は見積もりに切り替える。
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            try:
+                _encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            logger.warning("failed to load the tiktoken encoding, estimating token counts", exc_info=True)
+            _encoding = False
+    return _encoding
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """
+    テキストのトークン数をローカルで数える。
+    tiktokenが使えない環境では、非ASCII文字を1文字1トークン、ASCIIを4文字1トークンとして見積もる。
+    """
+    encoding = _get_encoding() if tiktoken is not None else None
+    if encoding:
+        return len(encoding.encode(text))
+    non_ascii = sum(1 for c in text if ord(c) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+def count_message_tokens(messages: list[dict]) -> int:
+    return sum(count_tokens(m["content"]) + TOKENS_PER_MESSAGE for m in messages) + TOKENS_PER_REPLY
+
+class SummaryStore:
+    """
+    チャットごとの古い会話の要約を保持する。
+    要約は履歴の先頭からcovered件のメッセージをまとめたもので、バックグラウンドで更新する。
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def get(self, chat_id: str) -> tuple[int, str]:
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return 0, ""
+        self._entries.move_to_end(chat_id)
+        return entry
+
+    def put(self, chat_id: str, covered: int, summary: str):
+        self._entries[chat_id] = (covered, summary)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, chat_id: str):
+        self._entries.pop(chat_id, None)
+
+    def refresh(self, chat_id: str, messages: list[dict], covered: int, summary: str):
+        """要約がcovered件目以降の古いメッセージを含むよう、バックグラウンドで更新する"""
+        if chat_id in self._tasks:
+            return
+        task = asyncio.create_task(self._summarize(chat_id, list(messages), covered, summary))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(chat_id, None))
+
+    async def _summarize(self, chat_id: str, messages: list[dict], covered: int, summary: str):
+        conversation = "\n".join(f'{m["role"]}: {m["content"]}' for m in messages[covered:])
+        if summary:
+            conversation = f"これまでの要約: {summary}\n{conversation}"
+        # チャットの応答とLLMのスロットを共有し、空きがなければ後のターンで要約し直す
+        acquired_at = await governor.try_acquire()
+        if acquired_at is None:
+            logger.info("skipped summarizing chat %s: no free LLM slot", chat_id)
+            return
+        try:
+            text = await call_openai([
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": conversation},
+            ], model=SUMMARY_MODEL)
+        except Exception:
+            logger.exception("failed to summarize chat %s", chat_id)
+            return
+        finally:
+            governor.release(acquired_at)
+        self.put(chat_id, len(messages), text)
+
+summary_store = SummaryStore(HISTORY_CACHE_SIZE)
+
+def build_context(chat_id: str, prefix: list[dict], history: list[dict], budget: int = CONTEXT_TOKEN_BUDGET) -> tuple[list[dict], int]:
+    """
+    モデルに送るメッセージ列とそのトークン数を返す。
+    prefix(システムプロンプトとfew-shot)は常に含め、残りの予算に収まる直近のメッセージをそのまま送る。
+    収まらない古いメッセージは要約に置き換え、要約が追いついていなければバックグラウンドで更新する。
+    """
+    covered, summary = summary_store.get(chat_id)
+    summary_message = {"role": "system", "content": f"これまでの会話の要約: {summary}"} if summary else None
+    used = count_message_tokens(prefix)
+    if summary_message:
+        # 要約を使う場合に備えて予算から確保しておく
+        used += count_tokens(summary_message["content"]) + TOKENS_PER_MESSAGE
+
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        cost = count_tokens(history[i]["content"]) + TOKENS_PER_MESSAGE
+        if used + cost > budget and len(history) - i > CONTEXT_MIN_RECENT_MESSAGES:
+            break
+        used += cost
+        start = i
+    # 要約の境界はユーザーの発話の直前に揃える
+    while start < len(history) and history[start]["role"] != "user":
+        used -= count_tokens(history[start]["content"]) + TOKENS_PER_MESSAGE
+        start += 1
+
+    if start == 0:
+        if summary_message:
+            used -= count_tokens(summary_message["content"]) + TOKENS_PER_MESSAGE
+        return prefix + history, used
+
+    if covered < start:
+        summary_store.refresh(chat_id, history[:start], covered, summary)
+    messages = list(prefix)
+    if summary_message:
+        messages.append(summary_message)
+    messages.extend(history[start:])
+    return messages, used
@@ -1,20 +1,117 @@
-from sqlalchemy import create_engine, Column, String, ForeignKey, DateTime, Boolean, Text
+from sqlalchemy import create_engine, event, Column, String, ForeignKey, DateTime, Boolean, Text, Integer, Index
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime
+import importlib.util
 import uuid
-from config import SQLALCHEMY_DATABASE_URL
+from config import (
+    SQLALCHEMY_DATABASE_URL,
+    ASYNC_DATABASE_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_SYNC_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    SQLITE_BUSY_TIMEOUT,
+)
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# 同期URLのドライバに対応する非同期ドライバ
+ASYNC_DRIVERS = {
+    "sqlite": ("sqlite+aiosqlite", "aiosqlite"),
+    "postgresql": ("postgresql+asyncpg", "asyncpg"),
+}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """複数ワーカーからの同時書き込みで database is locked にならないよう、WALと待ち時間を設定する"""
+    cursor = dbapi_connection.cursor()
+    # 新しいファイルでは削除で空いたページをincremental_vacuumで少しずつ返せるようにする(既存のファイルはVACUUM後に有効)
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+def engine_options(url: str, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW) -> dict:
+    if make_url(url).get_backend_name() == "sqlite":
+        return {"connect_args": {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT / 1000}}
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+def pool_sizes(has_async: bool) -> tuple[tuple[int, int], tuple[int, int]]:
+    """
+    ワーカーあたりの接続数がDB_POOL_SIZE + DB_MAX_OVERFLOWを超えないよう、
+    同期エンジンと非同期エンジンの(pool_size, max_overflow)を分けて返す。
+    pool_sizeが0だと上限なしになるため、どちらにも1以上を割り当てる。
+    """
+    if not has_async:
+        return (DB_POOL_SIZE, DB_MAX_OVERFLOW), (0, 0)
+    sync_size = max(1, min(DB_SYNC_POOL_SIZE, DB_POOL_SIZE - 1))
+    return (sync_size, 0), (max(1, DB_POOL_SIZE - sync_size), DB_MAX_OVERFLOW)
+
+def create_db_engine(url: str, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW):
+    engine = create_engine(url, **engine_options(url, pool_size, max_overflow))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+def async_database_url(url: str | None) -> str | None:
+    """
+    非同期エンジンのURL。未指定なら同期URLから組み立て、
+    対応する非同期ドライバがインストールされていなければNoneを返す(run_dbはスレッドプールで同期セッションを使う)。
+    """
+    if url:
+        return url
+    sync_url = make_url(SQLALCHEMY_DATABASE_URL)
+    driver = ASYNC_DRIVERS.get(sync_url.get_backend_name())
+    if driver is None or importlib.util.find_spec(driver[1]) is None:
+        return None
+    return sync_url.set(drivername=driver[0]).render_as_string(hide_password=False)
+
+def create_async_db_engine(url: str, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    async_engine = create_async_engine(url, **engine_options(url, pool_size, max_overflow))
+    if async_engine.dialect.name == "sqlite":
+        event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+    return async_engine
+
+_async_url = async_database_url(ASYNC_DATABASE_URL)
+_sync_pool, _async_pool = pool_sizes(_async_url is not None)
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL, *_sync_pool)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if _async_url is not None:
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    async_engine = create_async_db_engine(_async_url, *_async_pool)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+else:
+    async_engine = None
+    AsyncSessionLocal = None
 Base = declarative_base()
 
+class PromptTemplate(Base):
+    __tablename__ = "prompt_templates"
+
+    id = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
+    version = Column(Integer, unique=True, index=True)
+    # システムプロンプトとfew-shotのメッセージ列(JSON)
+    content = Column(Text)
+    created_at = Column(DateTime, default=datetime.now)
+
 class Chat(Base):
     __tablename__ = "chats"
 
     id = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     created_at = Column(DateTime, default=datetime.now)
+    # NULLの場合は旧形式(シード行をmessagesに保存しているチャット)
+    prompt_template_id = Column(String, ForeignKey("prompt_templates.id"), nullable=True)
     messages = relationship("Message", back_populates="chat")
+    prompt_template = relationship("PromptTemplate")
 
 class Message(Base):
     __tablename__ = "messages"
@@ -27,16 +124,28 @@ class Message(Base):
 
     chat = relationship("Chat", back_populates="messages")
 
+    __table_args__ = (
+        # チャット単位の履歴取得用
+        Index("ix_messages_chat_id_created_at", "chat_id", "created_at"),
+        # 期間を指定したエクスポート用
+        Index("ix_messages_created_at", "created_at"),
+    )
+
 class Menu(Base):
     __tablename__ = "menus"
 
     id = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     name = Column(String, unique=True, index=True)
+    # beverage または dish
+    category = Column(String)
+    description = Column(Text)
+    # カンマ区切り
     ingredients = Column(Text)
     allergies = Column(Text)
     is_halal = Column(Boolean, default=False)
-
-Base.metadata.create_all(bind=engine)
+    # 栄養成分表示(JSON)
+    nutrition = Column(Text)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
 def get_db():
     db=SessionLocal()
@@ -44,3 +153,24 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        raise RuntimeError("async database driver (aiosqlite / asyncpg) is not installed")
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def _run_with_session(fn, *args):
+    with SessionLocal() as db:
+        return fn(db, *args)
+
+async def run_db(fn, *args):
+    """
+    fn(db, *args)をイベントループを止めずに実行する。
+    非同期エンジンがあればAsyncSession上で、なければスレッドプールで同期セッションを使う。
+    fnはセッションの外でも使える値(ORMオブジェクト以外)を返すこと。
+    """
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            return await db.run_sync(fn, *args)
+    return await run_in_threadpool(_run_with_session, fn, *args)
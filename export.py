@@ -0,0 +1,141 @@
+import base64
+import binascii
+import json
+import secrets
+from datetime import datetime
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import Session
+from db import Chat, Message, engine, run_db
+from persistence import message_writer
+from prompt import LEGACY_SEED_COUNT
+from config import MESSAGES_PAGE_SIZE, MESSAGES_PAGE_MAX, EXPORT_BATCH_SIZE, ADMIN_TOKEN
+
+def require_admin(authorization: str | None = Header(default=None)):
+    """Authorization: Bearer <ADMIN_TOKEN> を確認する。ADMIN_TOKENが未設定なら管理用のAPIは使えない"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+
+router = APIRouter()
+# 全チャットの会話を返すため、管理者のトークンを必須にする
+admin_router = APIRouter(dependencies=[Depends(require_admin)])
+
+MESSAGE_COLUMNS = (Message.id, Message.chat_id, Message.role, Message.content, Message.created_at)
+
+def legacy_seed_ids(chat_ids: list[str] | None = None):
+    """
+    旧形式のチャット(prompt_template_idがNULL)の先頭LEGACY_SEED_COUNT行のIDを選ぶクエリ。
+    シード行は本文ではなく位置で判定するため、few-shotの例と同じ文の実際の発話は除外されない。
+    """
+    position = func.row_number().over(
+        partition_by=Message.chat_id,
+        order_by=(Message.created_at, Message.id),
+    ).label("position")
+    ranked = (
+        select(Message.id, position)
+        .join(Chat, Chat.id == Message.chat_id)
+        .where(Chat.prompt_template_id.is_(None))
+    )
+    if chat_ids is not None:
+        ranked = ranked.where(Message.chat_id.in_(chat_ids))
+    ranked = ranked.subquery()
+    return select(ranked.c.id).where(ranked.c.position <= LEGACY_SEED_COUNT)
+
+def visible_messages(chat_ids: list[str] | None = None):
+    """システムプロンプトとシード行を除いたメッセージを選ぶクエリ。chat_idsを渡すとそのチャットに絞る"""
+    stmt = (
+        select(*MESSAGE_COLUMNS)
+        .where(Message.role != "system")
+        .where(Message.id.not_in(legacy_seed_ids(chat_ids)))
+    )
+    if chat_ids is not None:
+        stmt = stmt.where(Message.chat_id.in_(chat_ids))
+    return stmt
+
+def message_to_dict(row) -> dict:
+    return {
+        "id": row.id,
+        "chat_id": row.chat_id,
+        "role": row.role,
+        "content": row.content,
+        "created_at": row.created_at.isoformat(),
+    }
+
+def encode_cursor(row) -> str:
+    payload = json.dumps([row.created_at.isoformat(), row.id])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, message_id = json.loads(payload)
+        return datetime.fromisoformat(created_at), str(message_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def query_messages_page(db: Session, chat_id: str, after: tuple[datetime, str] | None, limit: int) -> dict | None:
+    """
+    (created_at, id)の順でafterより後のメッセージをlimit件返す。
+    OFFSETを使わないため、ページが進んでもインデックスの範囲検索だけで済む。
+    """
+    if db.query(Chat.id).filter(Chat.id == chat_id).first() is None:
+        return None
+    stmt = visible_messages([chat_id])
+    if after is not None:
+        created_at, message_id = after
+        stmt = stmt.where(or_(
+            Message.created_at > created_at,
+            and_(Message.created_at == created_at, Message.id > message_id),
+        ))
+    # 次のページがあるかを知るため1件多く読む
+    rows = db.execute(stmt.order_by(Message.created_at, Message.id).limit(limit + 1)).all()
+    page = rows[:limit]
+    return {
+        "messages": [message_to_dict(row) for row in page],
+        "next_cursor": encode_cursor(page[-1]) if len(rows) > limit else None,
+    }
+
+@router.get("/chat/{chat_id}/messages")
+async def list_messages(
+    chat_id: str,
+    cursor: str | None = None,
+    limit: int = Query(default=MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+):
+    after = decode_cursor(cursor) if cursor else None
+    # キューに残っている書き込みを先にコミットしてから読む
+    await message_writer.flush()
+    page = await run_db(query_messages_page, chat_id, after, limit)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return page
+
+def iter_export(chat_ids: list[str], since: datetime | None, until: datetime | None):
+    """
+    条件に合うメッセージをNDJSONで1行ずつ返す。
+    サーバーサイドカーソルでEXPORT_BATCH_SIZE行ずつ取り出すため、件数によらずメモリ使用量は一定になる。
+    StreamingResponseが同期ジェネレータをスレッドプールで回すため、イベントループは止まらない。
+    """
+    stmt = visible_messages(chat_ids or None)
+    if since is not None:
+        stmt = stmt.where(Message.created_at >= since)
+    if until is not None:
+        stmt = stmt.where(Message.created_at < until)
+    stmt = stmt.order_by(Message.created_at, Message.id)
+
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(stmt)
+        for rows in result.partitions():
+            yield "".join(json.dumps(message_to_dict(row), ensure_ascii=False) + "\n" for row in rows)
+
+@admin_router.get("/export/messages")
+async def export_messages(
+    chat_id: list[str] = Query(default=[]),
+    since: datetime | None = None,
+    until: datetime | None = None,
+):
+    await message_writer.flush()
+    return StreamingResponse(iter_export(chat_id, since, until), media_type="application/x-ndjson")
@@ -0,0 +1,168 @@
+import re
+from catalog import Catalog, name_keywords
+
+# 表記ゆれをアレルギー物質名にまとめる
+ALLERGEN_ALIASES = {
+    "牛乳": "乳",
+    "ミルク": "乳",
+    "乳製品": "乳",
+    "乳成分": "乳",
+    "ピーチ": "もも",
+    "桃": "もも",
+    "たまご": "卵",
+    "玉子": "卵",
+    "ソイ": "大豆",
+}
+
+NUTRIENT_ALIASES = {
+    "カロリー": "熱量",
+    "kcal": "熱量",
+    "熱量": "熱量",
+    "たんぱく質": "たんぱく質",
+    "タンパク質": "たんぱく質",
+    "脂質": "脂質",
+    "炭水化物": "炭水化物",
+    "糖質": "炭水化物",
+    "塩分": "食塩相当量",
+    "食塩": "食塩相当量",
+}
+
+CONTAINS_QUESTION = re.compile(r'入って|含ま|使って|使用|アレルギー')
+EXCLUDE_QUESTION = re.compile(r'入っていない|入ってない|含まない|含まれていない|使っていない|なし|以外|でも飲め|でも食べ')
+# おすすめを求める質問は条件の組み合わせをLLMに任せる
+RECOMMEND_QUESTION = re.compile(r'おすすめ|オススメ|お勧め|お薦め|人気|甘く|合う|飲みたい|食べたい|ほしい|欲しい')
+# かなの語の直前・直後にあっても、語の区切りとみなす助詞
+PARTICLES = set("がはをにのもとやでへかよ")
+KANA = re.compile(r'[ぁ-んァ-ヶー]')
+HALAL_QUESTION = re.compile(r'ハラール|ハラル|halal', re.IGNORECASE)
+BEVERAGE_WORDS = re.compile(r'飲み物|ドリンク|飲料')
+DISH_WORDS = re.compile(r'料理|食べ物|フード|メニュー')
+
+def _tags(items: list[dict]) -> str:
+    return "".join(f'[{item["id"]}]' for item in items)
+
+def _names(items: list[dict]) -> str:
+    return "、".join(f'「{item["name"]}」' for item in items)
+
+def _joined(text: str, i: int) -> bool:
+    """text[i]が前後のかなの語とつながる文字か"""
+    return 0 <= i < len(text) and KANA.fullmatch(text[i]) is not None and text[i] not in PARTICLES
+
+class FastPath:
+    """
+    アレルギー・ハラール・栄養成分の定型的な質問を、LLMを呼ばずにカタログから直接答える。
+    答えられない質問にはNoneを返し、通常どおりLLMに任せる。
+    """
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        self._version = None
+        self._allergen_pattern: re.Pattern | None = None
+        self._nutrient_pattern = re.compile("|".join(sorted(map(re.escape, NUTRIENT_ALIASES), key=len, reverse=True)), re.IGNORECASE)
+
+    def _build(self):
+        """カタログが更新されていればアレルギー物質の照合パターンを作り直す"""
+        if self._version == self.catalog.version:
+            return
+        terms = set(self.catalog.by_allergen) | set(ALLERGEN_ALIASES)
+        self._allergen_pattern = re.compile("|".join(sorted(map(re.escape, terms), key=len, reverse=True))) if terms else None
+        self._version = self.catalog.version
+
+    def answer(self, text: str) -> str | None:
+        self._build()
+        if RECOMMEND_QUESTION.search(text):
+            return None
+        items = self.catalog.find_items(text)
+        # 商品名に含まれる語(「ピーチ」など)をアレルギー物質として拾わないよう取り除く
+        rest = text
+        for item in items:
+            for keyword in name_keywords(item["name"]):
+                rest = rest.replace(keyword, "")
+
+        if HALAL_QUESTION.search(rest):
+            return self._answer_halal(rest, items)
+        if CONTAINS_QUESTION.search(rest):
+            allergens = self._find_allergens(rest)
+            if allergens is None or len(allergens) > 1:
+                return None
+            if allergens:
+                return self._answer_allergen(rest, items, allergens[0])
+            if items and "アレルギー" in rest:
+                return self._answer_allergen_list(items)
+        nutrient = self._nutrient_pattern.search(rest)
+        if nutrient and items:
+            return self._answer_nutrition(items, NUTRIENT_ALIASES[nutrient.group().lower()])
+        return None
+
+    def _find_allergens(self, text: str) -> list[str] | None:
+        """
+        質問に含まれるアレルギー物質を重複なく返す。
+        かなの語が長い語の一部(「子どもも」の「もも」など)として現れた場合は判断できないためNoneを返す。
+        """
+        if self._allergen_pattern is None:
+            return []
+        allergens: list[str] = []
+        for m in self._allergen_pattern.finditer(text):
+            if KANA.fullmatch(m.group()[0]) and (_joined(text, m.start() - 1) or _joined(text, m.end())):
+                return None
+            allergen = ALLERGEN_ALIASES.get(m.group(), m.group())
+            if allergen not in allergens:
+                allergens.append(allergen)
+        return allergens
+
+    def _candidates(self, text: str) -> list[dict]:
+        items = list(self.catalog.items.values())
+        if BEVERAGE_WORDS.search(text):
+            items = [item for item in items if item["category"] == "beverage"]
+        elif DISH_WORDS.search(text):
+            items = [item for item in items if item["category"] == "dish"]
+        return items
+
+    def _answer_halal(self, text: str, items: list[dict]) -> str | None:
+        if items:
+            halal = [item for item in items if item["is_halal"]]
+            others = [item for item in items if not item["is_halal"]]
+            sentences = []
+            if halal:
+                sentences.append(f"{_names(halal)}はハラール対応です。")
+            if others:
+                sentences.append(f"{_names(others)}はハラール対応の確認が取れておりません。")
+            return "".join(sentences) + _tags(items)
+        halal = [item for item in self._candidates(text) if item["is_halal"]]
+        if not halal:
+            return None
+        return f"ハラール対応のメニューは{_names(halal)}です。{_tags(halal)}"
+
+    def _answer_allergen(self, text: str, items: list[dict], allergen: str) -> str | None:
+        if items:
+            sentences = []
+            for item in items:
+                if allergen in item["allergies"]:
+                    sentences.append(f"「{item['name']}」には{allergen}が含まれています。")
+                else:
+                    sentences.append(f"「{item['name']}」には{allergen}は含まれていません。")
+            return "".join(sentences) + _tags(items)
+        if not EXCLUDE_QUESTION.search(text):
+            return None
+        free = [item for item in self._candidates(text) if allergen not in item["allergies"]]
+        if not free:
+            return f"申し訳ございませんが、{allergen}が含まれていないメニューはございません。"
+        return f"{allergen}が含まれていないメニューは{_names(free)}です。{_tags(free)}"
+
+    def _answer_allergen_list(self, items: list[dict]) -> str:
+        sentences = []
+        for item in items:
+            if item["allergies"]:
+                sentences.append(f"「{item['name']}」のアレルギー物質は{'、'.join(item['allergies'])}です。")
+            else:
+                sentences.append(f"「{item['name']}」にアレルギー物質は含まれていません。")
+        return "".join(sentences) + _tags(items)
+
+    def _answer_nutrition(self, items: list[dict], nutrient: str) -> str | None:
+        sentences = []
+        for item in items:
+            value = item["nutrition"].get(nutrient)
+            if value is None:
+                # 栄養成分表示がないメニューはLLMに任せる
+                return None
+            sentences.append(f"「{item['name']}」の{nutrient}は{value}です。")
+        return "".join(sentences) + _tags(items)
@@ -0,0 +1,107 @@
+import hashlib
+import math
+import unicodedata
+from collections import OrderedDict
+from config import FEWSHOT_K, FEWSHOT_TOKEN_BUDGET
+from context import count_tokens, TOKENS_PER_MESSAGE
+from prompt import FEW_SHOT_EXAMPLES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NGRAM_SIZES = (2, 3)
+
+def char_ngrams(text: str) -> list[str]:
+    text = "".join(unicodedata.normalize("NFKC", text).lower().split())
+    grams = []
+    for n in NGRAM_SIZES:
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+class FewShotStore:
+    """
+    few-shotの例から、質問に近いものを選ぶ。
+    例の質問を文字n-gramのTF-IDFでベクトル化し、コサイン類似度の高い順にトークン上限まで選ぶ。
+    NumPyがあれば行列積でまとめて計算し、なければ疎ベクトルの内積で計算する。
+    """
+    def __init__(self, examples: list[tuple[str, str]], cache_size: int = 1024):
+        self.examples = examples
+        self._costs: list[int] | None = None
+        documents = [char_ngrams(question) for question, _ in examples]
+        df: dict[str, int] = {}
+        for grams in documents:
+            for gram in set(grams):
+                df[gram] = df.get(gram, 0) + 1
+        self.vocabulary = {gram: i for i, gram in enumerate(sorted(df))}
+        self.idf = [math.log((1 + len(documents)) / (1 + df[gram])) + 1 for gram in sorted(df)]
+        self.vectors = [self._vectorize(grams) for grams in documents]
+        if np is not None:
+            self.matrix = np.zeros((len(examples), len(self.vocabulary)))
+            for row, vector in enumerate(self.vectors):
+                for col, value in vector.items():
+                    self.matrix[row, col] = value
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, list[int]] = OrderedDict()
+
+    @property
+    def costs(self) -> list[int]:
+        """各例のトークン数。インポート時にトークナイザを読み込まないよう、最初に選ぶときに数える"""
+        if self._costs is None:
+            self._costs = [
+                count_tokens(question) + count_tokens(answer) + 2 * TOKENS_PER_MESSAGE
+                for question, answer in self.examples
+            ]
+        return self._costs
+
+    def _vectorize(self, grams: list[str]) -> dict[int, float]:
+        tf: dict[int, float] = {}
+        for gram in grams:
+            col = self.vocabulary.get(gram)
+            if col is not None:
+                tf[col] = tf.get(col, 0) + 1
+        vector = {col: count * self.idf[col] for col, count in tf.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        return {col: v / norm for col, v in vector.items()} if norm else {}
+
+    def scores(self, text: str) -> list[float]:
+        query = self._vectorize(char_ngrams(text))
+        if np is not None:
+            q = np.zeros(len(self.vocabulary))
+            for col, value in query.items():
+                q[col] = value
+            return (self.matrix @ q).tolist()
+        return [sum(value * vector.get(col, 0) for col, value in query.items()) for vector in self.vectors]
+
+    def select_indices(self, text: str, k: int = FEWSHOT_K, budget: int = FEWSHOT_TOKEN_BUDGET, fallback: bool = True) -> list[int]:
+        key = hashlib.sha256(f"{k}:{budget}:{fallback}:{text}".encode("utf-8")).hexdigest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+
+        scores = self.scores(text)
+        ranked = sorted(range(len(self.examples)), key=lambda i: -scores[i])
+        # 似ている例がなければ、fallbackがTrueの場合のみ先頭の(一般的な)例を使う
+        relevant = [i for i in ranked if scores[i] > 0]
+        if relevant or not fallback:
+            ranked = relevant
+        costs = self.costs
+        selected, used = [], 0
+        for i in ranked:
+            if len(selected) >= k:
+                break
+            if used + costs[i] > budget:
+                continue
+            selected.append(i)
+            used += costs[i]
+        # 元の並び順で渡す
+        selected.sort()
+
+        self._cache[key] = selected
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return selected
+
+few_shot_store = FewShotStore(FEW_SHOT_EXAMPLES)
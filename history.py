@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from db import Chat, Message, run_db
+from persistence import message_writer
+from config import HISTORY_CACHE_SIZE, HISTORY_CACHE_REVALIDATE
+
+class ChatHistory:
+    __slots__ = ("prompt_template_id", "messages")
+
+    def __init__(self, prompt_template_id: str | None, messages: list[dict]):
+        self.prompt_template_id = prompt_template_id
+        self.messages = messages
+
+class HistoryCache:
+    """
+    最近使われたチャットの会話履歴を保持するLRU。
+    ターンごとに作り直さず、保存したメッセージを末尾に追加していく。
+    キャッシュはワーカーごとに持つため、他のワーカーが同じチャットに書き込んだ場合に備えて
+    load_historyで使う前にDBのメッセージ数と照合する。
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, ChatHistory] = OrderedDict()
+
+    def get(self, chat_id: str) -> ChatHistory | None:
+        history = self._entries.get(chat_id)
+        if history is not None:
+            self._entries.move_to_end(chat_id)
+        return history
+
+    def put(self, chat_id: str, history: ChatHistory):
+        if self.maxsize <= 0:
+            return
+        self._entries[chat_id] = history
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def append(self, chat_id: str, role: str, content: str):
+        history = self._entries.get(chat_id)
+        if history is not None:
+            history.messages.append({"role": role, "content": content})
+
+    def discard(self, chat_id: str):
+        self._entries.pop(chat_id, None)
+
+history_cache = HistoryCache(HISTORY_CACHE_SIZE)
+
+def query_history(db: Session, chat_id: str) -> ChatHistory | None:
+    """ORMオブジェクトを介さず、列の値だけで会話履歴を読み込む"""
+    row = db.query(Chat.prompt_template_id).filter(Chat.id == chat_id).first()
+    if row is None:
+        return None
+    rows = (
+        db.query(Message.role, Message.content)
+        .filter(Message.chat_id == chat_id)
+        .order_by(Message.created_at, Message.id)
+        .all()
+    )
+    return ChatHistory(row.prompt_template_id, [{"role": role, "content": content} for role, content in rows])
+
+def query_state(db: Session, chat_id: str) -> tuple[str | None, int] | None:
+    """チャットのテンプレートIDと保存済みのメッセージ数。メッセージ数は(chat_id, created_at)のインデックスだけで数える"""
+    count = select(func.count()).where(Message.chat_id == chat_id).scalar_subquery()
+    row = db.execute(select(Chat.prompt_template_id, count).where(Chat.id == chat_id)).first()
+    return tuple(row) if row is not None else None
+
+async def is_current(chat_id: str, history: ChatHistory) -> bool:
+    """
+    キャッシュした履歴がDBと一致しているか確認する。
+    このワーカーのキューにあるメッセージはキャッシュにだけあるため、その分を除いて数える。
+    他のワーカーのキューにあるメッセージは、コミットされるまで(MESSAGE_FLUSH_INTERVAL以内)見えない。
+    """
+    state = await run_db(query_state, chat_id)
+    expected = (history.prompt_template_id, len(history.messages) - message_writer.pending(chat_id))
+    return state == expected
+
+async def load_history(chat_id: str) -> ChatHistory | None:
+    """
+    チャットの会話履歴を返す。チャットが存在しなければNoneを返す。
+    キャッシュにないか、他のワーカーの書き込みや整理でDBと食い違っている場合にDBから読み込む。
+    """
+    history = history_cache.get(chat_id)
+    if history is not None:
+        if not HISTORY_CACHE_REVALIDATE or await is_current(chat_id, history):
+            return history
+        history_cache.discard(chat_id)
+
+    # キューに残っている書き込みを先にコミットしてから読む
+    await message_writer.flush()
+    history = await run_db(query_history, chat_id)
+    if history is not None:
+        history_cache.put(chat_id, history)
+    return history
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import AsyncIterator
+from fastapi import HTTPException
+from config import IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_TURNS
+
+logger = logging.getLogger(__name__)
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+class Turn:
+    """
+    Idempotency-Keyを付けた1ターンの応答。
+    生成は接続から切り離したタスクで最後まで進め、送ったイベントを順に保持する。
+    """
+    def __init__(self, content: str):
+        self.content_hash = content_hash(content)
+        self.expires_at = 0.0
+        self.headers: dict = {}
+        self.events: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.changed = asyncio.Event()
+        # 生成を始めたらNone、始める前に断られたらその例外が入る
+        self.started: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task: asyncio.Task | None = None
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def replay(self, start: int = 0):
+        """start番目以降のイベントを返し、生成中であれば続きが届くのを待つ"""
+        i = max(start, 0)
+        while True:
+            while i < len(self.events):
+                yield self.events[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self.changed.wait()
+
+class TurnStore:
+    """
+    (チャットID, Idempotency-Key)ごとのターンを、終わってからttl秒間保持する。
+    同じキーで再送されたリクエストには、モデルを呼び直さず保持している応答を途中から返す。
+    ワーカーごとに持つため、再送が別のワーカーに届いた場合は新しいターンとして扱われる。
+    """
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_turns: int = IDEMPOTENCY_MAX_TURNS):
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self._turns: OrderedDict[tuple[str, str], Turn] = OrderedDict()
+
+    def _purge(self):
+        # 終わったターンは終わった順に末尾へ移しているため、先頭から期限切れのものを捨てる
+        now = time.monotonic()
+        for key, turn in list(self._turns.items()):
+            if not turn.done:
+                continue
+            if turn.expires_at > now:
+                break
+            del self._turns[key]
+        # 上限を超えた分は終わったターンから古い順に捨て、生成中のターンは残す
+        excess = len(self._turns) - self.max_turns
+        if excess > 0:
+            for key in [key for key, turn in self._turns.items() if turn.done][:excess]:
+                del self._turns[key]
+
+    def claim(self, chat_id: str, key: str, content: str) -> tuple[Turn, bool]:
+        """キーのターンを返す。新しく作った場合は2番目の値がTrueになる"""
+        self._purge()
+        turn = self._turns.get((chat_id, key))
+        if turn is not None:
+            if turn.content_hash != content_hash(content):
+                raise HTTPException(status_code=422, detail="Idempotency-Key was used with a different message")
+            return turn, False
+        turn = Turn(content)
+        self._turns[(chat_id, key)] = turn
+        return turn, True
+
+    def fail(self, chat_id: str, key: str, turn: Turn, error: BaseException):
+        """生成を始める前に断られたターンを取り消す。待っている再送には同じ例外を返す"""
+        if self._turns.get((chat_id, key)) is turn:
+            del self._turns[(chat_id, key)]
+        if not turn.started.done():
+            turn.started.set_exception(error)
+            # 再送が待っていない場合に未取得の例外として警告されないようにする
+            turn.started.exception()
+
+    def start(self, chat_id: str, key: str, turn: Turn, events: AsyncIterator[str], releases: list, headers: dict | None = None):
+        turn.headers = headers or {}
+        turn.task = asyncio.create_task(self._produce(chat_id, key, turn, events, releases))
+        turn.started.set_result(None)
+
+    async def _produce(self, chat_id: str, key: str, turn: Turn, events: AsyncIterator[str], releases: list):
+        try:
+            async for event in events:
+                turn.events.append(event)
+                turn.notify()
+        except BaseException as e:
+            turn.error = e
+            # 途中で失敗したターンは残さず、再送されたら作り直す
+            if self._turns.get((chat_id, key)) is turn:
+                del self._turns[(chat_id, key)]
+            if not isinstance(e, asyncio.CancelledError):
+                logger.exception("chat turn %s failed", chat_id)
+            else:
+                raise
+        finally:
+            turn.done = True
+            turn.expires_at = time.monotonic() + self.ttl
+            if self._turns.get((chat_id, key)) is turn:
+                self._turns.move_to_end((chat_id, key))
+            turn.notify()
+            for release in releases:
+                release()
+
+    async def drain(self, timeout: float):
+        """生成中のターンが終わって応答が保存されるまで待つ"""
+        tasks = [turn.task for turn in self._turns.values() if turn.task is not None and not turn.task.done()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+turn_store = TurnStore()
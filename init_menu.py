@@ -1,16 +1,91 @@
-from db import get_db, Menu, Base, engine
-Base.metadata.create_all(bind=engine)
-
-db = next(get_db())
-
-menu_data = [
-    {"name": "チキンカレー", "ingredients": "鶏肉,玉ねぎ,スパイス", "allergies": "なし", "is_halal": True},
-    {"name": "ビーフカレー", "ingredients": "牛肉,玉ねぎ,スパイス", "allergies": "牛肉アレルギー", "is_halal": False},
-    {"name": "野菜カレー", "ingredients": "ジャガイモ,ニンジン,玉ねぎ,スパイス", "allergies": "なし", "is_halal": True},
-]
-
-for m in menu_data:
-    menu = Menu(**m)
-    db.add(menu)
-db.commit()
-db.close()
+"""
+メニューをJSONまたはCSVファイルからMenuテーブルに読み込む。
+IDが同じ行は上書きし(商品名の変更を含む)、内容が変わっていない行は更新しないため、何度実行してもよい。
+
+    poetry run python init_menu.py                  # menu.json
+    poetry run python init_menu.py menu.json extra.csv
+
+CSVの列は id,name,category,description,ingredients,allergies,is_halal,nutrition 。
+ingredients と allergies はカンマ区切り、nutrition はJSONで書く。
+"""
+import argparse
+import csv
+import json
+import os
+from datetime import datetime
+from sqlalchemy import or_
+from db import Menu, engine
+from migrate import migrate
+
+# 1文で書き込む行数
+BATCH_SIZE = 500
+UPDATE_COLUMNS = ("name", "category", "description", "ingredients", "allergies", "is_halal", "nutrition")
+
+def parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+def join_list(value) -> str:
+    if isinstance(value, str):
+        return value
+    return ",".join(value or [])
+
+def to_row(m: dict) -> dict:
+    nutrition = m.get("nutrition") or {}
+    if isinstance(nutrition, str):
+        nutrition = json.loads(nutrition)
+    return {
+        "id": m["id"],
+        "name": m["name"],
+        "category": m.get("category") or "dish",
+        "description": m.get("description") or "",
+        "ingredients": join_list(m.get("ingredients")),
+        "allergies": join_list(m.get("allergies")),
+        "is_halal": parse_bool(m.get("is_halal", False)),
+        "nutrition": json.dumps(nutrition, ensure_ascii=False),
+        "updated_at": datetime.now(),
+    }
+
+def load_file(path: str) -> list[dict]:
+    with open(path, encoding="utf-8", newline="") as f:
+        if os.path.splitext(path)[1].lower() == ".csv":
+            return [to_row(m) for m in csv.DictReader(f)]
+        return [to_row(m) for m in json.load(f)]
+
+def upsert_statement(dialect: str):
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(Menu)
+    changed = [getattr(Menu, c).is_distinct_from(stmt.excluded[c]) for c in UPDATE_COLUMNS]
+    return stmt.on_conflict_do_update(
+        index_elements=[Menu.id],
+        set_={c: stmt.excluded[c] for c in UPDATE_COLUMNS + ("updated_at",)},
+        # 内容が同じ行はupdated_atも変えず、カタログの再読み込みを起こさない
+        where=or_(*changed),
+    )
+
+def upsert_menus(rows: list[dict]) -> int:
+    if engine.dialect.name not in ("sqlite", "postgresql"):
+        raise ValueError(f"upsert is not supported for {engine.dialect.name}")
+    # 同じファイル内でIDが重複している場合は後の行を使う
+    rows = list({row["id"]: row for row in rows}.values())
+    stmt = upsert_statement(engine.dialect.name)
+    with engine.begin() as conn:
+        for i in range(0, len(rows), BATCH_SIZE):
+            conn.execute(stmt, rows[i:i + BATCH_SIZE])
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", default=["menu.json"])
+    args = parser.parse_args()
+
+    migrate()
+    rows = [row for path in args.paths for row in load_file(path)]
+    print(f"loaded {upsert_menus(rows)} menus")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import json
+import random
+from collections import OrderedDict
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_MODEL,
+    LLM_PROVIDER,
+    LLM_TIMEOUT,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE,
+    FAKE_LLM_LATENCY,
+    FAKE_LLM_TOKEN_RATE,
+)
+from metrics import UPSTREAM_PROMPT_TOKENS, CACHED_PROMPT_TOKENS, PROMPT_CACHE_RATIO, COALESCED_REQUESTS
+
+def record_usage(model: str, prompt_tokens: int, cached_tokens: int):
+    """プロバイダが返したトークン数から、プレフィックスキャッシュがどれだけ効いたかを記録する"""
+    UPSTREAM_PROMPT_TOKENS.inc(prompt_tokens, model=model)
+    CACHED_PROMPT_TOKENS.inc(cached_tokens, model=model)
+    if prompt_tokens:
+        PROMPT_CACHE_RATIO.observe(cached_tokens / prompt_tokens)
+
+def _record_openai_usage(model: str, usage):
+    if usage is None:
+        return
+    details = usage.prompt_tokens_details
+    record_usage(model, usage.prompt_tokens, (details.cached_tokens or 0) if details else 0)
+
+class OpenAIProvider:
+    """OpenAIのAPIを非同期クライアントで呼ぶ"""
+    def __init__(self):
+        if not OPENAI_API_KEY:
+            raise ValueError("OPENAI_API_KEY is not set in the environment variables")
+        import httpx
+        from openai import AsyncOpenAI
+
+        # ワーカー内で共有するコネクションプール
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=5.0),
+        )
+        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=self.http_client, timeout=LLM_TIMEOUT)
+
+    async def complete(self, messages, model: str) -> str:
+        response = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            timeout=LLM_TIMEOUT,
+        )
+        _record_openai_usage(model, response.usage)
+        return response.choices[0].message.content.strip()
+
+    async def stream(self, messages, model: str):
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            timeout=LLM_TIMEOUT,
+            stream=True,
+            # 最後のチャンクでトークン数(キャッシュされたトークン数を含む)を受け取る
+            stream_options={"include_usage": True},
+        )
+        async with stream:
+            async for chunk in stream:
+                _record_openai_usage(model, chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+
+    async def close(self):
+        await self.client.close()
+
+FAKE_REPLIES = [
+    "定番の「コカ・コーラ」や、幅広い世代に人気の「カルピスウォーター」はいかがでしょうか。好みの味や今の気分を教えていただければ、それに合わせた飲み物をおすすめできます。[coca-cola][calpis-water]",
+    "もしリラックスしたい気分でしたら、「ジャスミン茶」の心地よい香りはいかがでしょうか。[jasmine]",
+    "「黒烏龍茶」は脂肪の吸収を抑える効果があるため、ダイエット中におすすめです。[black-oolong]",
+    "しっかり桃を感じられる「フルボディピーチ&カルピス」や、マスカットの果実感が楽しめる「マスカットウォーター」がおすすめです。[peach-calpis][mascotto]",
+    "エネルギーをチャージしたい時は、ガラナ・マカ・アルギニンなどの成分が配合された「ドデカミン」が最適です。[dodecamine]",
+    "申し訳ございませんが、当店ではアイスのみの提供となっております。",
+]
+
+class FakeProvider:
+    """
+    負荷試験用のローカルなLLMの代役。
+    最初のトークンまでlatency秒待ち、その後token_rateトークン/秒で定型の回答を返す。
+    回答は最後のユーザー発話から決まるため、同じ質問には同じ回答を返す。
+    """
+    # 日本語のおおよその1トークンあたりの文字数
+    CHARS_PER_TOKEN = 2
+
+    # プレフィックスキャッシュを真似るために覚えておくプレフィックスの数
+    MAX_PREFIXES = 10000
+
+    def __init__(self, latency: float = FAKE_LLM_LATENCY, token_rate: float = FAKE_LLM_TOKEN_RATE, replies: list[str] = FAKE_REPLIES):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.replies = replies
+        self._prefixes: OrderedDict[str, None] = OrderedDict()
+
+    def _record_usage(self, messages, model: str):
+        """以前に送られたメッセージ列と先頭から一致する部分を、キャッシュされたトークンとして数える"""
+        digest = hashlib.sha256()
+        tokens = cached = 0
+        for m in messages:
+            digest.update(json.dumps([m["role"], m["content"]], ensure_ascii=False).encode("utf-8"))
+            key = digest.hexdigest()
+            hit = key in self._prefixes and cached == tokens
+            tokens += len(m["content"]) // self.CHARS_PER_TOKEN + 1
+            if hit:
+                cached = tokens
+                self._prefixes.move_to_end(key)
+            else:
+                self._prefixes[key] = None
+        while len(self._prefixes) > self.MAX_PREFIXES:
+            self._prefixes.popitem(last=False)
+        record_usage(model, tokens, cached)
+
+    def _reply(self, messages) -> str:
+        question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        return random.Random(question).choice(self.replies)
+
+    async def complete(self, messages, model: str) -> str:
+        reply = self._reply(messages)
+        self._record_usage(messages, model)
+        await asyncio.sleep(self.latency + len(reply) / self.CHARS_PER_TOKEN / self.token_rate)
+        return reply
+
+    async def stream(self, messages, model: str):
+        reply = self._reply(messages)
+        self._record_usage(messages, model)
+        await asyncio.sleep(self.latency)
+        for i in range(0, len(reply), self.CHARS_PER_TOKEN):
+            yield reply[i:i + self.CHARS_PER_TOKEN]
+            await asyncio.sleep(1 / self.token_rate)
+
+    async def close(self):
+        pass
+
+PROVIDERS = {
+    "openai": OpenAIProvider,
+    "fake": FakeProvider,
+}
+
+_provider = None
+
+def get_provider():
+    """LLM_PROVIDERで選ばれたプロバイダを最初に使うときに作る"""
+    global _provider
+    if _provider is None:
+        if LLM_PROVIDER not in PROVIDERS:
+            raise ValueError(f"Unknown LLM_PROVIDER: {LLM_PROVIDER}")
+        _provider = PROVIDERS[LLM_PROVIDER]()
+    return _provider
+
+async def call_openai(messages, model: str = OPENAI_MODEL) -> str:
+    """補完をまとめて取得する"""
+    return await get_provider().complete(messages, model)
+
+def fingerprint(messages) -> str:
+    payload = json.dumps([OPENAI_MODEL, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class _Flight:
+    """上流の1つのストリームを、同じペイロードを待つ複数のリクエストに配る"""
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+_inflight: dict[str, _Flight] = {}
+
+async def _produce(key: str, flight: _Flight, messages):
+    try:
+        async for delta in get_provider().stream(messages, OPENAI_MODEL):
+            flight.chunks.append(delta)
+            flight.notify()
+    except BaseException as e:
+        flight.error = e
+        if isinstance(e, asyncio.CancelledError):
+            raise
+    finally:
+        flight.done = True
+        if _inflight.get(key) is flight:
+            del _inflight[key]
+        flight.notify()
+
+def in_flight(messages) -> bool:
+    """同じペイロードの補完が進行中で、stream_openaiがそれを共有するかどうか"""
+    return fingerprint(messages) in _inflight
+
+async def stream_openai(messages):
+    """
+    補完をストリーミングで取得し、テキストの差分を順に返す。
+    同じペイロードの補完が進行中であれば新たに上流へ送らず、そのストリームを最初から共有する。
+    クライアントが切断されるとStreamingResponseがこのジェネレータを閉じ、
+    共有しているリクエストがなくなれば上流のストリームも閉じる。
+    """
+    key = fingerprint(messages)
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = _Flight()
+        flight.task = asyncio.create_task(_produce(key, flight, messages))
+        _inflight[key] = flight
+    else:
+        COALESCED_REQUESTS.inc()
+
+    flight.subscribers += 1
+    try:
+        i = 0
+        while True:
+            while i < len(flight.chunks):
+                yield flight.chunks[i]
+                i += 1
+            if flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+            await flight.changed.wait()
+    finally:
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done:
+            flight.task.cancel()
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+
+async def close_client():
+    global _provider
+    if _provider is not None:
+        await _provider.close()
+        _provider = None
@@ -0,0 +1,175 @@
+"""
+/start_chat と /chat/{chat_id} に並行してリクエストを送り、レイテンシとスループットを測る。
+
+--url を指定しない場合は、LLM_PROVIDER=fake と一時的なSQLiteファイルでサーバーを起動するため、
+OpenAIのAPIを呼ばずにオフラインで実行できる。
+
+    poetry run python loadtest.py --chats 200 --concurrency 50 --turns 3
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+QUESTIONS = [
+    "特に飲みたいものが決まっていないんですが、おすすめの飲み物はありますか？",
+    "甘いものが飲みたいです。",
+    "リラックスできる飲み物はありますか？",
+    "カルピスウォーターに乳は入っていますか？",
+    "コカ・コーラのカロリーは？",
+    "果物系の飲み物が飲みたいです。",
+]
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[k]
+
+def report(name: str, values: list[float]):
+    print(
+        f"{name:<18} n={len(values):<6} "
+        f"p50={percentile(values, 50) * 1000:8.1f}ms "
+        f"p95={percentile(values, 95) * 1000:8.1f}ms "
+        f"p99={percentile(values, 99) * 1000:8.1f}ms"
+    )
+
+class Stats:
+    def __init__(self):
+        self.start_chat: list[float] = []
+        self.turn: list[float] = []
+        self.first_chunk: list[float] = []
+        # 応答キャッシュの結果(X-Cache)ごとのターンの所要時間
+        self.by_cache: dict[str, list[float]] = {}
+        self.errors = 0
+
+async def run_chat(client: httpx.AsyncClient, stats: Stats, turns: int, index: int):
+    started = time.perf_counter()
+    r = await client.post("/start_chat")
+    stats.start_chat.append(time.perf_counter() - started)
+    if r.status_code != 200:
+        stats.errors += 1
+        return
+    chat_id = r.json()["chat_id"]
+
+    for turn in range(turns):
+        question = QUESTIONS[(index + turn) % len(QUESTIONS)]
+        started = time.perf_counter()
+        first_chunk = None
+        async with client.stream("POST", f"/chat/{chat_id}", json={"content": question}) as r:
+            if r.status_code != 200:
+                await r.aread()
+                stats.errors += 1
+                return
+            async for line in r.aiter_lines():
+                if first_chunk is None and line:
+                    first_chunk = time.perf_counter() - started
+            cache = r.headers.get("X-Cache", "none")
+        stats.turn.append(time.perf_counter() - started)
+        stats.by_cache.setdefault(cache, []).append(stats.turn[-1])
+        if first_chunk is not None:
+            stats.first_chunk.append(first_chunk)
+
+async def run(url: str, chats: int, concurrency: int, turns: int):
+    stats = Stats()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(i: int):
+        async with semaphore:
+            try:
+                await run_chat(client, stats, turns, i)
+            except httpx.HTTPError:
+                stats.errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(chats)))
+        elapsed = time.perf_counter() - started
+
+    requests = len(stats.start_chat) + len(stats.turn)
+    print(f"chats={chats} turns={turns} concurrency={concurrency} elapsed={elapsed:.2f}s errors={stats.errors}")
+    print(f"throughput         {requests / elapsed:.1f} req/s")
+    report("start_chat", stats.start_chat)
+    report("chat (total)", stats.turn)
+    report("chat (first chunk)", stats.first_chunk)
+    # キャッシュから返したターンとモデルを呼んだターンを分けて見る(noneはキャッシュを引かなかったターン)
+    for cache, values in sorted(stats.by_cache.items()):
+        report(f"chat (cache {cache})", values)
+    return stats
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            httpx.get(url + "/healthz", timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not become ready")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="測定対象のURL。省略するとfakeプロバイダでサーバーを起動する")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.5, help="fakeプロバイダの最初のトークンまでの時間(秒)")
+    parser.add_argument("--token-rate", type=float, default=50, help="fakeプロバイダの1秒あたりのトークン数")
+    parser.add_argument(
+        "--cache", default="none", choices=["none", "memory", "sqlite"],
+        help="起動するサーバーの応答キャッシュ。質問の種類が少ないため、既定では無効にしてモデルを呼ぶ経路を測る",
+    )
+    args = parser.parse_args()
+
+    if args.url:
+        asyncio.run(run(args.url, args.chats, args.concurrency, args.turns))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        env = dict(
+            os.environ,
+            LLM_PROVIDER="fake",
+            FAKE_LLM_LATENCY=str(args.latency),
+            FAKE_LLM_TOKEN_RATE=str(args.token_rate),
+            DATABASE_URL=f"sqlite:///{tmp}/loadtest.db",
+            RESPONSE_CACHE_PATH=f"{tmp}/response_cache.db",
+            ARCHIVE_DIR=f"{tmp}/archive",
+            RESPONSE_CACHE_BACKEND=args.cache,
+            # すべてのリクエストが同じIPアドレスから届き、思考時間なしで送るため、送信回数の上限は外す
+            RATE_LIMIT_PER_MINUTE="1000000",
+            RATE_LIMIT_BURST="1000000",
+            CHAT_RATE_LIMIT_PER_MINUTE="1000000",
+            CHAT_RATE_LIMIT_BURST="1000000",
+        )
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        subprocess.run([sys.executable, "init_menu.py"], cwd=cwd, env=env, check=True)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=cwd,
+            env=env,
+        )
+        url = f"http://127.0.0.1:{port}"
+        try:
+            wait_ready(url, server)
+            asyncio.run(run(url, args.chats, args.concurrency, args.turns))
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    main()
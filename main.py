@@ -1,8 +1,33 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from chat import router as chat_router
+from export import router as export_router, admin_router
+from metrics import router as metrics_router, MetricsMiddleware, track_queries
+from db import engine, async_engine
 from fastapi.middleware.cors import CORSMiddleware
+from llm import close_client
+from persistence import message_writer
+from maintenance import maintenance
+from payload import payload_builder
+from idempotency import turn_store
+from config import LLM_TIMEOUT
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await message_writer.start()
+    # 共通のプレフィックスは最初のリクエストを待たずに作っておく
+    await payload_builder.warm()
+    await maintenance.start()
+    yield
+    await maintenance.stop()
+    # 接続から切り離して生成しているターンの応答を保存し終えるまで待つ
+    await turn_store.drain(LLM_TIMEOUT)
+    # 未コミットのメッセージを書き込んでから、共有コネクションプールを閉じる
+    await message_writer.stop()
+    await close_client()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "https://famires-app.pages.dev"],
@@ -13,6 +38,18 @@ app.add_middleware(
 
 # チャットのAPIルータをマウントする
 app.include_router(chat_router)
+app.include_router(export_router)
+app.include_router(admin_router)
+app.include_router(metrics_router)
+
+@app.get("/healthz")
+async def healthz():
+    # 起動処理(lifespan)が終わると応答する
+    return {"status": "ok"}
+
+track_queries(engine)
+if async_engine is not None:
+    track_queries(async_engine.sync_engine)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,287 @@
+"""
+チャットとメッセージのテーブルが際限なく大きくならないよう、バックグラウンドで定期的に整理する。
+
+- 最後のメッセージからCHAT_RETENTION_DAYS日が経ったチャットを圧縮したNDJSONに書き出してから削除する
+- 旧形式のチャットがmessagesに保存しているシード行を削除し、現行のプロンプトテンプレートを参照させる
+- SQLiteでは削除で空いたページをincremental_vacuumで返し、PRAGMA optimizeで統計を更新する
+
+どの処理もMAINTENANCE_BATCH_SIZE件ずつの短いトランザクションに分け、バッチの間は待つため、
+書き込みロックを長く握ってチャットの応答を止めることはない。
+
+    poetry run python maintenance.py            # 1回だけ実行する
+    poetry run python maintenance.py --vacuum   # 既存のSQLiteファイルでincremental_vacuumを有効にする(全体をVACUUMする)
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import delete, exists, select, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from db import Chat, Message, engine, run_db
+from export import message_to_dict, visible_messages
+from history import history_cache
+from persistence import message_writer
+from context import summary_store
+from prompt import LEGACY_SEED_COUNT, LEGACY_SEED_TEXTS, get_current_template_id
+from metrics import Counter
+from config import (
+    CHAT_RETENTION_DAYS,
+    ARCHIVE_DIR,
+    MAINTENANCE_INTERVAL,
+    MAINTENANCE_BATCH_SIZE,
+    MAINTENANCE_PAUSE,
+    VACUUM_PAGES,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_CHATS = Counter("maintenance_chats_total", "Chats processed by background maintenance", ("action",))
+
+def archive_path(started: datetime) -> str:
+    suffix = "ndjson.zst" if zstandard is not None else "ndjson.gz"
+    return os.path.join(ARCHIVE_DIR, f"chats-{started:%Y%m%d-%H%M%S}.{suffix}")
+
+def write_archive(path: str, lines: list[str]):
+    """
+    バッチごとに独立した圧縮フレーム(gzipのメンバー)として追記する。
+    zstd / gzip はどちらも連結したフレームをそのまま展開できる。
+    """
+    data = "".join(lines).encode("utf-8")
+    data = zstandard.ZstdCompressor().compress(data) if path.endswith(".zst") else gzip.compress(data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        # DBから削除する前にアーカイブがディスクに残っていることを保証する
+        os.fsync(f.fileno())
+
+def select_expired(db: Session, cutoff: datetime, limit: int) -> tuple[list[str], list[str]]:
+    """
+    cutoffより後にメッセージがないチャットをlimit件選び、(チャットのID, アーカイブに書く行)を返す。
+    旧形式のチャットの先頭LEGACY_SEED_COUNT行とシステムメッセージ以外の、削除する行をすべて書き出す。
+    """
+    recent = exists().where(Message.chat_id == Chat.id, Message.created_at >= cutoff)
+    chats = db.execute(
+        select(Chat.id, Chat.created_at, Chat.prompt_template_id)
+        .where(Chat.created_at < cutoff, ~recent)
+        .limit(limit)
+    ).all()
+    if not chats:
+        return [], []
+    ids = [chat.id for chat in chats]
+
+    messages: dict[str, list[dict]] = {chat_id: [] for chat_id in ids}
+    rows = db.execute(
+        visible_messages(ids)
+        .where(Message.created_at < cutoff)
+        .order_by(Message.created_at, Message.id)
+    )
+    for row in rows:
+        message = message_to_dict(row)
+        del message["chat_id"]
+        messages[row.chat_id].append(message)
+    lines = [
+        json.dumps({
+            "chat_id": chat.id,
+            "created_at": chat.created_at.isoformat() if chat.created_at else None,
+            "prompt_template_id": chat.prompt_template_id,
+            "messages": messages[chat.id],
+        }, ensure_ascii=False) + "\n"
+        for chat in chats
+    ]
+    return ids, lines
+
+def delete_expired(db: Session, cutoff: datetime, ids: list[str]):
+    # 選んだ後にメッセージが届いたチャットは、そのメッセージとチャットを残す
+    db.execute(delete(Message).where(Message.chat_id.in_(ids), Message.created_at < cutoff))
+    db.execute(delete(Chat).where(Chat.id.in_(ids), ~exists().where(Message.chat_id == Chat.id)))
+    db.commit()
+
+def compact_batch(db: Session, limit: int) -> list[str]:
+    """
+    旧形式のチャットをlimit件選び、先頭のシード行(システムプロンプトとfew-shotの例)を削除して
+    現行のテンプレートを参照させる。
+    """
+    ids = db.scalars(select(Chat.id).where(Chat.prompt_template_id.is_(None)).limit(limit)).all()
+    if not ids:
+        return []
+    template_id = get_current_template_id(db)
+
+    seed_ids = []
+    counts = dict.fromkeys(ids, 0)
+    rows = db.execute(
+        select(Message.id, Message.chat_id, Message.role, Message.content)
+        .where(Message.chat_id.in_(ids))
+        .order_by(Message.chat_id, Message.created_at, Message.id)
+    )
+    for row in rows:
+        if counts[row.chat_id] >= LEGACY_SEED_COUNT:
+            continue
+        counts[row.chat_id] += 1
+        if row.role == "system" or row.content in LEGACY_SEED_TEXTS:
+            seed_ids.append(row.id)
+
+    if seed_ids:
+        db.execute(delete(Message).where(Message.id.in_(seed_ids)))
+    db.execute(update(Chat).where(Chat.id.in_(ids)).values(prompt_template_id=template_id))
+    db.commit()
+    return list(ids)
+
+def vacuum_step(db: Session, pages: int) -> tuple[int, int]:
+    """空きページを最大pagesだけファイルから返し、(返したページ数, 残りの空きページ数)を返す"""
+    conn = db.connection()
+    before = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+    conn.exec_driver_sql(f"PRAGMA incremental_vacuum({pages})")
+    after = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+    db.commit()
+    return before - after, after
+
+def optimize(db: Session):
+    db.connection().exec_driver_sql("PRAGMA optimize")
+    db.commit()
+
+class Maintenance:
+    """
+    一定間隔で整理を実行する。
+    複数のワーカーで動いている場合は、ファイルロックを取れたワーカーだけが実行する。
+    """
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL, batch_size: int = MAINTENANCE_BATCH_SIZE, pause: float = MAINTENANCE_PAUSE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("maintenance failed")
+            await asyncio.sleep(self.interval)
+
+    def _lock(self):
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        lock = open(os.path.join(ARCHIVE_DIR, ".maintenance.lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                return None
+        return lock
+
+    async def run_once(self) -> dict:
+        lock = self._lock()
+        if lock is None:
+            logger.info("maintenance is running in another worker")
+            return {}
+        try:
+            stats = {
+                "archived": await self.expire(),
+                "compacted": await self.compact(),
+            }
+            if engine.dialect.name == "sqlite":
+                stats["vacuumed"] = await self.vacuum()
+            logger.info("maintenance finished: %s", stats)
+            return stats
+        finally:
+            lock.close()
+
+    async def _batches(self, step) -> int:
+        """await step(batch_size)がbatch_size件未満を返すまでバッチを繰り返し、処理したチャットのキャッシュを捨てる"""
+        total = 0
+        while True:
+            # キューにある書き込みを先にコミットし、削除したチャットにメッセージが残らないようにする
+            await message_writer.flush()
+            ids = await step(self.batch_size)
+            for chat_id in ids:
+                history_cache.discard(chat_id)
+                summary_store.discard(chat_id)
+            total += len(ids)
+            if len(ids) < self.batch_size:
+                return total
+            await asyncio.sleep(self.pause)
+
+    async def expire(self) -> int:
+        if CHAT_RETENTION_DAYS <= 0:
+            return 0
+        started = datetime.now()
+        cutoff = started - timedelta(days=CHAT_RETENTION_DAYS)
+        path = archive_path(started)
+
+        async def step(limit: int) -> list[str]:
+            """
+            圧縮とfsyncはイベントループを止めないようスレッドプールで行い、アーカイブを書いてから削除する。
+            削除に失敗した場合は、次回に同じチャットが重複して書き出されることがある。
+            """
+            ids, lines = await run_db(select_expired, cutoff, limit)
+            if ids:
+                await run_in_threadpool(write_archive, path, lines)
+                await run_db(delete_expired, cutoff, ids)
+            return ids
+
+        count = await self._batches(step)
+        MAINTENANCE_CHATS.inc(count, action="archived")
+        return count
+
+    async def compact(self) -> int:
+        count = await self._batches(lambda limit: run_db(compact_batch, limit))
+        MAINTENANCE_CHATS.inc(count, action="compacted")
+        return count
+
+    async def vacuum(self) -> int:
+        total = 0
+        while True:
+            freed, remaining = await run_db(vacuum_step, VACUUM_PAGES)
+            total += freed
+            # auto_vacuumが無効なファイルでは空きページが減らない
+            if freed == 0 or remaining == 0:
+                break
+            await asyncio.sleep(self.pause)
+        await run_db(optimize)
+        return total
+
+maintenance = Maintenance()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vacuum", action="store_true", help="auto_vacuum=INCREMENTALにしてからファイル全体をVACUUMする")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.vacuum:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+    asyncio.run(maintenance.run_once())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import time
+from contextlib import contextmanager
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+router = APIRouter()
+
+# 秒単位のレイテンシ用
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self.samples()
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # ラベルごとに [各バケットの件数..., 合計値, 件数]
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, data in self.values.items():
+            for bound, count in zip(self.buckets, data):
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {data[-1]}")
+        return lines
+
+REGISTRY: list[Metric] = []
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time until the last byte of the response", ("method", "path", "status"))
+TTFB_SECONDS = Histogram("http_time_to_first_byte_seconds", "Time until the first byte of the response body", ("method", "path"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served")
+STAGE_SECONDS = Histogram("chat_stage_duration_seconds", "Time spent in each stage of a chat request", ("stage",))
+PROMPT_TOKENS = Histogram("llm_prompt_tokens", "Prompt tokens sent to the model per request", buckets=TOKEN_BUCKETS)
+COMPLETION_TOKENS = Histogram("llm_completion_tokens", "Completion tokens per reply", buckets=TOKEN_BUCKETS)
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Time spent executing SQL statements")
+UPSTREAM_PROMPT_TOKENS = Counter("llm_upstream_prompt_tokens_total", "Prompt tokens reported by the provider", ("model",))
+CACHED_PROMPT_TOKENS = Counter("llm_cached_prompt_tokens_total", "Prompt tokens served from the provider's prefix cache", ("model",))
+PROMPT_CACHE_RATIO = Histogram("llm_prompt_cache_ratio", "Share of prompt tokens served from the prefix cache per request", buckets=(0, 0.1, 0.25, 0.5, 0.75, 0.9, 1))
+REPLIES = Counter("chat_replies_total", "Replies by the way they were produced", ("source",))
+COALESCED_REQUESTS = Counter("llm_coalesced_requests_total", "Requests that shared an in-flight completion with the same payload")
+IDEMPOTENT_REPLAYS = Counter("chat_idempotent_replays_total", "Retried chat turns answered from the idempotency buffer")
+
+class Profile:
+    """
+    1リクエストの各段階の所要時間を記録する。
+    enabledがTrueの場合は段階ごとの内訳を保持し、レスポンスに含められるようにする。
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float):
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        if self.enabled:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def breakdown(self) -> dict:
+        stages = {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()}
+        stages["total"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return stages
+
+def track_queries(engine):
+    """SQL文の実行時間を記録する"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_SECONDS.observe(time.perf_counter() - conn.info["query_started"].pop())
+
+class MetricsMiddleware:
+    """
+    レスポンスの最後のバイトまでの時間と最初のバイトまでの時間を記録する。
+    ストリーミングのレスポンスも本文を送り終えるまで測るため、ASGIミドルウェアとして実装している。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        state = {"status": 500, "first_byte": False}
+
+        def path() -> str:
+            # ルーティング後はscopeにルートが入るため、パスパラメータを含まないテンプレートで集計する
+            route = scope.get("route")
+            return route.path if route is not None else "unmatched"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body" and not state["first_byte"]:
+                state["first_byte"] = True
+                TTFB_SECONDS.observe(time.perf_counter() - started, method=scope["method"], path=path())
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_FLIGHT.dec()
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=scope["method"], path=path(), status=state["status"])
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,33 @@
+"""
+データベースのスキーマを作成・更新する。
+アプリケーションの起動時には実行しないため、デプロイ時やサーバーを起動する前に一度実行する。
+
+    poetry run python migrate.py
+"""
+from sqlalchemy import inspect, text
+from db import Base, engine
+
+def upgrade_schema(bind):
+    """
+    create_allは既存テーブルを変更しないため、モデルに追加された列とインデックスを補う。
+    追加する列はすべてNULL許容であること。
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(dialect=bind.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def migrate(bind=engine):
+    Base.metadata.create_all(bind=bind)
+    upgrade_schema(bind)
+
+if __name__ == "__main__":
+    migrate()
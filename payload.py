@@ -0,0 +1,74 @@
+from catalog import Catalog, catalog
+from context import build_context, count_message_tokens, count_tokens, TOKENS_PER_MESSAGE
+from fewshot import FewShotStore, few_shot_store
+from prompt import current_template_id, load_template_messages
+from db import run_db
+from config import CONTEXT_TOKEN_BUDGET, FEWSHOT_STATIC
+
+class Prefix:
+    __slots__ = ("catalog_version", "messages", "tokens")
+
+    def __init__(self, catalog_version: int, messages: list[dict], tokens: int):
+        self.catalog_version = catalog_version
+        self.messages = messages
+        self.tokens = tokens
+
+class PayloadBuilder:
+    """
+    モデルに送るメッセージ列を組み立てる。
+    プロバイダのプレフィックスキャッシュが効くよう、全チャットで共通の部分(システムプロンプト、メニュー一覧、
+    固定のfew-shot)を先頭に置き、テンプレートとカタログの組み合わせごとに一度だけ作って使い回す。
+    その後ろに要約と会話履歴を続け、質問ごとに変わるメニューデータと回答例は最後のユーザー発話の直前に置く。
+    """
+    def __init__(self, catalog: Catalog, few_shots: FewShotStore, static_examples: int = FEWSHOT_STATIC):
+        self.catalog = catalog
+        self.few_shots = few_shots
+        self.static_examples = static_examples
+        self._prefixes: dict[str, Prefix] = {}
+
+    def prefix(self, template_id: str, template_messages: list[dict]) -> Prefix:
+        prefix = self._prefixes.get(template_id)
+        if prefix is not None and prefix.catalog_version == self.catalog.version:
+            return prefix
+        messages = list(template_messages)
+        messages.append({"role": "system", "content": self.catalog.render_index()})
+        for question, answer in self.few_shots.examples[:self.static_examples]:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        prefix = Prefix(self.catalog.version, messages, count_message_tokens(messages))
+        self._prefixes[template_id] = prefix
+        return prefix
+
+    def dynamic(self, text: str) -> dict | None:
+        """質問に関係するメニューデータと、プレフィックスにない似た回答例をまとめたメッセージ"""
+        parts = []
+        data = self.catalog.render(text)
+        if data:
+            parts.append(data)
+        indices = [i for i in self.few_shots.select_indices(text, fallback=False) if i >= self.static_examples]
+        if indices:
+            examples = "\n".join(
+                f"質問: {self.few_shots.examples[i][0]}\n回答: {self.few_shots.examples[i][1]}" for i in indices
+            )
+            parts.append("### 回答例\n" + examples)
+        if not parts:
+            return None
+        return {"role": "system", "content": "\n\n".join(parts)}
+
+    def build(self, chat_id: str, template_id: str, template_messages: list[dict], turns: list[dict], budget: int = CONTEXT_TOKEN_BUDGET) -> tuple[list[dict], int]:
+        """turnsの最後はこのターンのユーザー発話。メッセージ列とそのトークン数を返す"""
+        prefix = self.prefix(template_id, template_messages)
+        dynamic = self.dynamic(turns[-1]["content"])
+        cost = count_tokens(dynamic["content"]) + TOKENS_PER_MESSAGE if dynamic else 0
+        messages, used = build_context(chat_id, prefix.messages, turns, budget - cost)
+        if dynamic:
+            messages.insert(len(messages) - 1, dynamic)
+        return messages, used + cost
+
+    async def warm(self):
+        """起動時にカタログを読み込み、現行テンプレートのプレフィックスを作っておく"""
+        await run_db(self.catalog.ensure_fresh)
+        template_id = await current_template_id()
+        self.prefix(template_id, await load_template_messages(template_id))
+
+payload_builder = PayloadBuilder(catalog, few_shot_store)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from db import Message, run_db
+from config import MESSAGE_QUEUE_SIZE, MESSAGE_BATCH_SIZE, MESSAGE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# コミットに失敗したバッチを再試行する回数
+MAX_RETRIES = 3
+
+def insert_messages(db: Session, rows: list[dict]):
+    db.execute(insert(Message), rows)
+    db.commit()
+
+class MessageWriter:
+    """
+    チャットのメッセージをキューに溜め、複数の会話の分をまとめて1トランザクションでコミットする。
+    batch_size件溜まるか、最初の1件からinterval秒経ったらコミットする。
+    起動していない場合(スクリプトなど)はその場でコミットする。
+    """
+    def __init__(self, max_queue: int = MESSAGE_QUEUE_SIZE, batch_size: int = MESSAGE_BATCH_SIZE, interval: float = MESSAGE_FLUSH_INTERVAL):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        # チャットごとの、キューに入れてまだコミットしていないメッセージ数
+        self._pending: dict[str, int] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """キューに残っているメッセージをすべてコミットしてから止める"""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def write(self, chat_id: str, role: str, content: str):
+        row = {
+            "id": str(uuid.uuid4()),
+            "chat_id": chat_id,
+            "role": role,
+            "content": content,
+            "created_at": datetime.now(),
+        }
+        if not self.running:
+            await run_db(insert_messages, [row])
+            return
+        self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+        # キューが満杯なら空くまで待つ
+        await self._queue.put(row)
+
+    def pending(self, chat_id: str) -> int:
+        return self._pending.get(chat_id, 0)
+
+    async def flush(self):
+        """この呼び出しより前に書き込まれたメッセージがコミットされるまで待つ"""
+        if not self.running:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        await self._queue.put(waiter)
+        await waiter
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            rows, waiters = [], []
+            deadline = asyncio.get_running_loop().time() + self.interval
+            while True:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, asyncio.Future):
+                    waiters.append(item)
+                else:
+                    rows.append(item)
+                if stopping or waiters or len(rows) >= self.batch_size:
+                    break
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if rows:
+                await self._commit(rows)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def _commit(self, rows: list[dict]):
+        try:
+            for attempt in range(MAX_RETRIES):
+                try:
+                    await run_db(insert_messages, rows)
+                    return
+                except Exception:
+                    logger.exception("failed to commit %d messages (attempt %d)", len(rows), attempt + 1)
+                    await asyncio.sleep(0.1 * 2 ** attempt)
+            logger.error("dropped %d messages after %d attempts", len(rows), MAX_RETRIES)
+        finally:
+            for row in rows:
+                count = self._pending.pop(row["chat_id"], 0) - 1
+                if count > 0:
+                    self._pending[row["chat_id"]] = count
+
+message_writer = MessageWriter()
@@ -0,0 +1,155 @@
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import json
+from db import PromptTemplate, run_db
+
+# プロンプトの内容を変更した場合はバージョンを上げる
+PROMPT_VERSION = 5
+
+SYSTEM_PROMPT = """
+            あなたはレストランの飲料説明やおすすめを行うチャットボットです。以下のガイドラインに従って回答してください。
+
+            ### 基本的な指示
+            1. **提供形式**:
+                - 飲み物はアイスのみの提供とします。ホット飲料のリクエストには「当店ではアイスのみの提供となっております」と回答してください。
+            2. **存在しないメニューへの対応**:
+                - 存在しないメニューについて質問された場合は、「申し訳ございませんが、そのメニューは当店では提供しておりません」と返答してください。
+            3. **アレルギー情報の提供**:
+                - 顧客からのアレルギーに関する質問には、各飲料のアレルギー情報を基に回答してください。
+            4. **栄養成分の説明**:
+                - 顧客が栄養成分について尋ねた場合、該当する飲料の栄養成分を提供してください。
+            5. **おすすめの提案**:
+                - 顧客の好みや質問内容に基づいて、最適な飲料をおすすめしてください。
+            6. **IDの併記**:
+                - 回答に具体的な商品名が含まれる際は、商品に対応するIDも併記してください。 例：「ジャスミン茶がおすすめです。[jasmine]」
+
+            ### メニューデータ
+            - 代表的なメニューは「### メニュー一覧」として渡されます。一覧は全メニューではないため、一覧にないことを理由に提供していないと答えないでください。
+            - 質問に関係するメニューの情報は、会話の途中に「### メニューデータ」として渡されます。メニューや特徴、アレルギー、栄養成分についてはその情報を基に回答してください。
+            - 質問されたメニューが「### メニューデータ」にも「### メニュー一覧」にもない場合は、提供していないと答えてください。
+            - 「### 回答例」が渡された場合は、その口調や形式を参考に回答してください。
+            """
+
+# few-shotの例 (ユーザーの質問, アシスタントの回答)
+FEW_SHOT_EXAMPLES = [
+    (
+        """「カルピス THE RICH 冬仕込み」は通常のカルピスとどう違いますか？""",
+        """北海道産ミルクとミルクソースが加わったことにより、より濃くてまろやかな味わいが楽しめます。""",
+    ),
+    (
+        """特に飲みたいものが決まっていないんですが、おすすめの飲み物はありますか？""",
+        """定番の「コカ・コーラ」や、幅広い世代に人気の「カルピスウォーター」はいかがでしょうか。好みの味や今の気分を教えていただければ、それに合わせた飲み物をおすすめできます。[coca-cola][calpis-water]""",
+    ),
+    (
+        """甘いものが飲みたいです。""",
+        """甘い飲み物では「コカ・コーラ」が人気です。もう少し甘さ控えめなものや、フルーティーなものがお好きであればおっしゃってください。[coca-cola]""",
+    ),
+    (
+        """冬にぴったりの飲み物はありますか？""",
+        """期間限定の「カルピス THE RICH 冬仕込み」や「フルボディピーチ&カルピス」がおすすめです。[calpis-rich][peach-calpis]""",
+    ),
+    (
+        """料理に合う飲み物はありますか？""",
+        """飲みやすい味わいの「黒烏龍茶」や、定番の「コカ・コーラ」などはいかがでしょうか。[black-oolong][coca-cola]""",
+    ),
+    (
+        """元気が出る飲み物がほしいです。""",
+        """エネルギーをチャージしたい時は、ガラナ・マカ・アルギニンなどの成分が配合された「ドデカミン」が最適です。[dodecamine]""",
+    ),
+    (
+        """爽快感のある飲み物はありますか？""",
+        """「ファンタ オレンジ」のキリッとした味わいと、炭酸の爽快感を味わうのはいかがでしょうか。[fanta-orange]""",
+    ),
+    (
+        """何か落ち着ける飲み物はありますか？""",
+        """もしゆっくりしたい気分でしたら、「綾鷹」や「ブラックコーヒー」で一息つくのはいかがでしょうか？[ayataka][coffee]""",
+    ),
+    (
+        """リラックスできる飲み物はありますか？""",
+        """もしリラックスしたい気分でしたら、「ジャスミン茶」の心地よい香りはいかがでしょうか。[jasmine]""",
+    ),
+    (
+        """ダイエット中におすすめの飲み物はありますか？""",
+        """「黒烏龍茶」は脂肪の吸収を抑える効果があるため、ダイエット中におすすめです。[black-oolong]""",
+    ),
+    (
+        """健康にいい飲み物はありますか？""",
+        """カフェインレスの「むぎ茶」や、特定保健用食品の「黒烏龍茶」がおすすめです。[mugi][black-oolong]""",
+    ),
+    (
+        """甘すぎないジュースが飲みたいです。""",
+        """すっきりとした果実感が感じられる「マスカットウォーター」や、ちょうどいい甘酸っぱさの「カルピスウォーター」がおすすめです。[mascotto][calpis-water]""",
+    ),
+    (
+        """さっぱりした雰囲気のものはありますか？""",
+        """さっぱりとした味わいがお好きでしたら、爽やかな香りが特徴の「ジャスミン茶」や、すっきりとした味わいの「マスカットウォーター」はいかがでしょうか？[jasmine][mascotto]""",
+    ),
+    (
+        """ヘルシーな飲み物はなんですか？""",
+        """お茶類全般は低カロリーなのでおすすめです。カフェインを気にされなければ、「ブラックコーヒー」も低カロリーですよ。[coffee]""",
+    ),
+    (
+        """果物系の飲み物が飲みたいです。""",
+        """しっかり桃を感じられる「フルボディピーチ&カルピス」や、マスカットの果実感が楽しめる「マスカットウォーター」がおすすめです。[peach-calpis][mascotto]""",
+    ),
+]
+
+# テンプレート導入前のチャットがmessagesに保存しているシード行の数(システムプロンプト + few-shot 15組)
+LEGACY_SEED_COUNT = 31
+# 旧形式のシード行のうち、システムプロンプト以外の本文
+LEGACY_SEED_TEXTS = frozenset(text for example in FEW_SHOT_EXAMPLES for text in example)
+
+_template_cache: dict[str, list[dict]] = {}
+_current_template_id: str | None = None
+
+def build_template_messages() -> list[dict]:
+    # few-shotの例はテンプレートに含めず、ターンごとに質問に近いものを選ぶ(fewshot.py)
+    return [{"role": "system", "content": SYSTEM_PROMPT}]
+
+def get_current_template_id(db: Session) -> str:
+    """
+    現行バージョンのプロンプトテンプレートのIDを返す。
+    まだ保存されていなければ一度だけ保存する。
+    """
+    global _current_template_id
+    if _current_template_id is not None:
+        return _current_template_id
+
+    template = db.query(PromptTemplate).filter(PromptTemplate.version == PROMPT_VERSION).first()
+    if not template:
+        template = PromptTemplate(
+            version=PROMPT_VERSION,
+            content=json.dumps(build_template_messages(), ensure_ascii=False),
+        )
+        db.add(template)
+        try:
+            db.commit()
+        except IntegrityError:
+            # 他のワーカーが先に保存した
+            db.rollback()
+            template = db.query(PromptTemplate).filter(PromptTemplate.version == PROMPT_VERSION).one()
+    _template_cache[template.id] = json.loads(template.content)
+    _current_template_id = template.id
+    return _current_template_id
+
+def get_template_messages(db: Session, template_id: str) -> list[dict]:
+    """
+    テンプレートのメッセージ列を返す。テンプレートは保存後に変更されないため、メモリ上にキャッシュする。
+    """
+    messages = _template_cache.get(template_id)
+    if messages is None:
+        template = db.query(PromptTemplate).filter(PromptTemplate.id == template_id).one()
+        messages = json.loads(template.content)
+        _template_cache[template_id] = messages
+    return messages
+
+async def current_template_id() -> str:
+    if _current_template_id is not None:
+        return _current_template_id
+    return await run_db(get_current_template_id)
+
+async def load_template_messages(template_id: str) -> list[dict]:
+    messages = _template_cache.get(template_id)
+    if messages is None:
+        messages = await run_db(get_template_messages, template_id)
+    return messages
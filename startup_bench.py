@@ -0,0 +1,83 @@
+"""
+ワーカーの起動にかかる時間を測る。
+
+- import: 新しいPythonプロセスで main をimportし終えるまで
+- ready:  uvicornのプロセスを起動してから /healthz が応答するまで(lifespanの起動処理を含む)
+
+スキーマの作成とメニューの読み込みは測定の前に一度だけ行う。OpenAIのAPIキーがなくても実行できる。
+
+    poetry run python startup_bench.py --runs 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from loadtest import free_port, percentile
+
+def measure_import(cwd: str, env: dict) -> float:
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True, capture_output=True, text=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+def measure_ready(cwd: str, env: dict, timeout: float = 30) -> float:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/healthz"
+    # 確認のたびにクライアントを作るとその時間も含まれるため、起動前に作っておく
+    client = httpx.Client(timeout=1)
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd,
+        env=env,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError("server exited during startup")
+            try:
+                if client.get(url).status_code == 200:
+                    return time.perf_counter() - started
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("server did not become ready")
+    finally:
+        client.close()
+        server.terminate()
+        server.wait()
+
+def report(name: str, values: list[float]):
+    print(
+        f"{name:<8} n={len(values):<4} "
+        f"p50={percentile(values, 50) * 1000:8.1f}ms "
+        f"p95={percentile(values, 95) * 1000:8.1f}ms "
+        f"max={max(values) * 1000:8.1f}ms"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{tmp}/startup.db",
+            RESPONSE_CACHE_PATH=f"{tmp}/response_cache.db",
+            ARCHIVE_DIR=f"{tmp}/archive",
+            MAINTENANCE_INTERVAL="0",
+        )
+        env.pop("OPENAI_API_KEY", None)
+        subprocess.run([sys.executable, "init_menu.py"], cwd=cwd, env=env, check=True, capture_output=True)
+
+        imports = [measure_import(cwd, env) for _ in range(args.runs)]
+        ready = [measure_ready(cwd, env) for _ in range(args.runs)]
+    report("import", imports)
+    report("ready", ready)
+
+if __name__ == "__main__":
+    main()
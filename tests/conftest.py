@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+# モジュールが設定を読み込む前に、一時ディレクトリのデータベースとアーカイブを使わせる
+_tmp = tempfile.mkdtemp(prefix="chatbot-test-")
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{_tmp}/test.db",
+    RESPONSE_CACHE_PATH=f"{_tmp}/response_cache.db",
+    ARCHIVE_DIR=f"{_tmp}/archive",
+    LLM_PROVIDER="fake",
+    FAKE_LLM_LATENCY="0",
+    FAKE_LLM_TOKEN_RATE="100000",
+    MAINTENANCE_INTERVAL="0",
+)
+
+import pytest
+from db import Base, engine
+from migrate import migrate
+
+@pytest.fixture
+def db():
+    migrate()
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    yield engine
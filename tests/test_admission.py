@@ -0,0 +1,45 @@
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+from admission import RateLimiter, client_key, parse_networks
+
+PROXIES = parse_networks(["10.0.0.0/8"])
+
+def make_request(headers: dict, host: str = "10.0.0.2") -> Request:
+    return Request({
+        "type": "http",
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+        "client": (host, 12345),
+    })
+
+def test_forwarded_header_is_ignored_without_trusted_proxy():
+    request = make_request({"X-Forwarded-For": "1.1.1.1", "CF-Connecting-IP": "2.2.2.2"})
+    assert client_key(request, hops=0, header="cf-connecting-ip", proxies=PROXIES) == "10.0.0.2"
+
+def test_spoofed_forwarded_entries_are_skipped():
+    # クライアントが送ったX-Forwarded-Forに前段のプロキシが接続元を追記している
+    request = make_request({"X-Forwarded-For": "6.6.6.6, 7.7.7.7, 203.0.113.5"})
+    assert client_key(request, hops=1, proxies=PROXIES) == "203.0.113.5"
+    assert client_key(request, hops=2, proxies=PROXIES) == "7.7.7.7"
+    assert client_key(make_request({"X-Forwarded-For": "203.0.113.5"}), hops=2, proxies=PROXIES) == "203.0.113.5"
+    assert client_key(make_request({}), hops=1, proxies=PROXIES) == "10.0.0.2"
+
+def test_client_ip_header_takes_precedence():
+    request = make_request({"X-Forwarded-For": "6.6.6.6, 198.51.100.1", "CF-Connecting-IP": "203.0.113.5"})
+    assert client_key(request, hops=1, header="cf-connecting-ip", proxies=PROXIES) == "203.0.113.5"
+    assert client_key(make_request({"X-Forwarded-For": "198.51.100.1"}), hops=1, header="cf-connecting-ip", proxies=PROXIES) == "198.51.100.1"
+
+def test_forwarded_header_is_ignored_from_untrusted_peer():
+    # プロキシを通さずに直接つないだクライアントが転送ヘッダを偽った
+    request = make_request({"X-Forwarded-For": "6.6.6.6", "CF-Connecting-IP": "7.7.7.7"}, host="198.51.100.9")
+    assert client_key(request, hops=1, header="cf-connecting-ip", proxies=PROXIES) == "198.51.100.9"
+
+def test_rate_limit_is_per_key():
+    limiter = RateLimiter(per_minute=1, burst=2)
+    limiter.check("chat-1")
+    limiter.check("chat-1")
+    with pytest.raises(HTTPException) as e:
+        limiter.check("chat-1")
+    assert e.value.status_code == 429
+    # 同じNATの内側にある別の端末は制限されない
+    limiter.check("chat-2")
@@ -0,0 +1,28 @@
+import asyncio
+from cache import ResponseCache, SqliteBackend, cache_key
+from catalog import Catalog
+from db import Menu
+
+def test_sqlite_backend_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "response_cache.db")
+    first = ResponseCache(SqliteBackend(path, 10, 60))
+    second = ResponseCache(SqliteBackend(path, 10, 60))
+
+    asyncio.run(first.set("key", "応答"))
+
+    assert asyncio.run(second.get("key")) == "応答"
+    assert asyncio.run(second.get("other")) is None
+    assert (second.hits, second.misses) == (1, 1)
+
+def test_menu_changes_change_the_key_in_every_worker():
+    menus = [Menu(id="jasmine", name="ジャスミン茶", description="香りの良いお茶。")]
+    first, second = Catalog(), Catalog()
+    first.load(menus)
+    second.load([Menu(id="jasmine", name="ジャスミン茶", description="香りの良いお茶。")])
+    messages = [{"role": "user", "content": "おすすめは？"}]
+    # 別々のワーカーでも同じメニューなら同じキーになり、共有しているキャッシュを使える
+    assert cache_key(messages, first.digest) == cache_key(messages, second.digest)
+
+    menus[0].description = "すっきりしたお茶。"
+    first.load(menus)
+    assert cache_key(messages, first.digest) != cache_key(messages, second.digest)
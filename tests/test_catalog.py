@@ -0,0 +1,28 @@
+import json
+from catalog import Catalog
+from config import CATALOG_MAX_LISTED
+from db import Menu
+
+def make_menus(count: int) -> list[Menu]:
+    return [
+        Menu(id=f"item-{i:03d}", name=f"商品{i}", category="dish", description=f"特徴{i}。詳しい説明。",
+             ingredients="", allergies="", is_halal=False, nutrition="{}")
+        for i in range(count)
+    ]
+
+def listed(catalog: Catalog) -> list[dict]:
+    header, _, body = catalog.render_index().partition("\n")
+    assert header == "### メニュー一覧"
+    return json.loads(body)
+
+def test_index_lists_features_for_small_menus():
+    catalog = Catalog()
+    catalog.load(make_menus(3))
+    assert listed(catalog) == [{"id": f"item-{i:03d}", "商品名": f"商品{i}", "特徴": f"特徴{i}"} for i in range(3)]
+
+def test_index_is_capped_for_large_menus():
+    catalog = Catalog()
+    catalog.load(make_menus(CATALOG_MAX_LISTED + 5))
+    # 毎ターン送るため上限で切り、一覧にない商品は検索で「### メニューデータ」に載せる
+    assert [entry["id"] for entry in listed(catalog)] == [f"item-{i:03d}" for i in range(CATALOG_MAX_LISTED)]
+    assert catalog.render(f"商品{CATALOG_MAX_LISTED + 4}について教えて") is not None
@@ -0,0 +1,54 @@
+import asyncio
+import json
+import uuid
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import insert, select
+from db import Chat, Message
+from chat import SentenceSplitter, chat_stream, iter_text, prefetch, split_sentence
+
+def test_splitter_keeps_a_sentence_split_across_chunks():
+    splitter = SentenceSplitter()
+    assert splitter.feed("いらっしゃい") == []
+    assert splitter.feed("ませ。ご注文") == ["いらっしゃいませ。"]
+    assert splitter.feed("は?何に") == ["ご注文は?"]
+    assert splitter.flush() == ["何に"]
+    assert splitter.flush() == []
+
+def test_splitter_handles_several_sentences_in_one_chunk():
+    splitter = SentenceSplitter()
+    assert splitter.feed("はい!おすすめです。ぜひ！") == ["はい!", "おすすめです。", "ぜひ！"]
+    assert splitter.flush() == []
+
+def test_split_sentence_keeps_the_unterminated_rest():
+    assert split_sentence("甘いです。冷たい") == ["甘いです。", "冷たい"]
+    assert split_sentence("") == []
+
+async def failing_stream(chunks: list[str]):
+    for chunk in chunks:
+        yield chunk
+    raise RuntimeError("upstream closed the connection")
+
+async def collect(events) -> list[dict]:
+    return [json.loads(event) async for event in events]
+
+def test_failure_before_the_first_token_is_a_502():
+    async def run():
+        with pytest.raises(HTTPException) as e:
+            await prefetch(failing_stream([]))
+        assert e.value.status_code == 502
+        deltas = await prefetch(failing_stream(["こんにちは"]))
+        assert await anext(deltas) == "こんにちは"
+        assert [d async for d in await prefetch(iter_text("はい。"))] == ["はい。"]
+
+    asyncio.run(run())
+
+def test_failure_mid_stream_sends_an_error_and_keeps_the_partial_reply(db):
+    chat_id = str(uuid.uuid4())
+    with db.begin() as conn:
+        conn.execute(insert(Chat).values(id=chat_id, prompt_template_id="template"))
+
+    events = asyncio.run(collect(chat_stream(failing_stream(["おすすめは", "緑茶です。"]), chat_id)))
+    assert events == [{"content": "おすすめは緑茶です。"}, {"status": "error"}]
+    with db.connect() as conn:
+        assert conn.execute(select(Message.content).where(Message.chat_id == chat_id)).scalars().all() == ["おすすめは緑茶です。"]
@@ -0,0 +1,45 @@
+import asyncio
+import context
+from admission import Governor
+from context import SummaryStore
+
+MESSAGES = [
+    {"role": "user", "content": "乳製品のアレルギーがあります"},
+    {"role": "assistant", "content": "承知しました"},
+]
+
+def test_summary_uses_a_governor_slot(monkeypatch):
+    governor = Governor(max_concurrent=1)
+    monkeypatch.setattr(context, "governor", governor)
+    active = []
+
+    async def call_openai(messages, model):
+        active.append(governor.active)
+        return "乳製品のアレルギーあり"
+
+    monkeypatch.setattr(context, "call_openai", call_openai)
+    store = SummaryStore(10)
+    asyncio.run(store._summarize("chat", MESSAGES, 0, ""))
+
+    assert active == [1]
+    assert governor.active == 0
+    assert store.get("chat") == (2, "乳製品のアレルギーあり")
+
+def test_summary_is_skipped_when_governor_is_busy(monkeypatch):
+    governor = Governor(max_concurrent=1)
+    monkeypatch.setattr(context, "governor", governor)
+
+    async def call_openai(messages, model):
+        raise AssertionError("summary must not wait for a busy LLM")
+
+    monkeypatch.setattr(context, "call_openai", call_openai)
+    store = SummaryStore(10)
+
+    async def run():
+        acquired_at = await governor.acquire()
+        await store._summarize("chat", MESSAGES, 0, "")
+        governor.release(acquired_at)
+
+    asyncio.run(run())
+    assert store.get("chat") == (0, "")
+    assert governor.active == 0
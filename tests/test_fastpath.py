@@ -0,0 +1,48 @@
+import json
+import os
+import re
+import pytest
+from catalog import Catalog
+from db import Menu
+from fastpath import FastPath
+from init_menu import to_row
+
+MENU_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "menu.json")
+
+@pytest.fixture(scope="module")
+def fast_path() -> FastPath:
+    with open(MENU_PATH, encoding="utf-8") as f:
+        rows = [to_row(m) for m in json.load(f)]
+    catalog = Catalog()
+    catalog.load([Menu(**{k: v for k, v in row.items() if k != "updated_at"}) for row in rows])
+    return FastPath(catalog)
+
+def tags(answer: str) -> set[str]:
+    return set(re.findall(r'\[([^\]]+)\]', answer))
+
+@pytest.mark.parametrize("question", [
+    # 「子どもも」の「もも」をアレルギー物質と取り違えない
+    "子どもも飲める、乳が入っていない飲み物はありますか？",
+    # 複数のアレルギー物質の組み合わせ
+    "ピーチ系で乳が入っていないものは？",
+    # おすすめを求める質問
+    "カルピスウォーターのカロリーが気になるけど、甘くないおすすめは？",
+    "乳が入っていないおすすめの飲み物は？",
+])
+def test_questions_left_to_the_llm(fast_path, question):
+    assert fast_path.answer(question) is None
+
+def test_exclusion_with_a_single_allergen(fast_path):
+    answer = fast_path.answer("乳が入っていない飲み物はありますか？")
+    assert answer.startswith("乳が含まれていないメニューは")
+    assert not tags(answer) & {"calpis-water", "calpis-rich", "peach-calpis"}
+    assert "jasmine" in tags(answer)
+
+def test_partial_name_covers_every_matching_item(fast_path):
+    answer = fast_path.answer("カルピスにアレルギー物質は入っていますか？")
+    assert tags(answer) == {"calpis-water", "calpis-rich", "peach-calpis"}
+
+def test_contains_and_nutrition(fast_path):
+    assert fast_path.answer("カルピスウォーターに乳は入っていますか？") == "「カルピスウォーター」には乳が含まれています。[calpis-water]"
+    assert fast_path.answer("ももが入っていない飲み物は？") is not None
+    assert fast_path.answer("カルピスウォーターのカロリーは？").startswith("「カルピスウォーター」の熱量は")
@@ -0,0 +1,27 @@
+import pytest
+import fewshot
+from fewshot import FewShotStore
+from prompt import FEW_SHOT_EXAMPLES
+
+def test_numpy_and_sparse_scores_match(monkeypatch):
+    pytest.importorskip("numpy")
+    dense = FewShotStore(FEW_SHOT_EXAMPLES)
+    monkeypatch.setattr(fewshot, "np", None)
+    sparse = FewShotStore(FEW_SHOT_EXAMPLES)
+    for text in ("ヘルシーな飲み物はなんですか？", "果物のジュース", "こんにちは"):
+        assert dense.scores(text) == pytest.approx(sparse.scores(text))
+        assert dense.select_indices(text, fallback=False) == sparse.select_indices(text, fallback=False)
+
+def test_unrelated_question_selects_nothing_without_fallback():
+    store = FewShotStore(FEW_SHOT_EXAMPLES)
+    assert store.select_indices("zzz", fallback=False) == []
+    assert store.select_indices("ヘルシーな飲み物はなんですか？", fallback=False)
+
+def test_costs_are_counted_on_first_selection(monkeypatch):
+    counted = []
+    monkeypatch.setattr(fewshot, "count_tokens", lambda text: counted.append(text) or 1)
+    # インポート時に作るため、トークナイザはまだ使わない
+    store = FewShotStore(FEW_SHOT_EXAMPLES)
+    assert counted == []
+    store.select_indices("ヘルシーな飲み物はなんですか？")
+    assert len(counted) == 2 * len(FEW_SHOT_EXAMPLES)
@@ -0,0 +1,61 @@
+import asyncio
+import uuid
+from datetime import datetime
+from sqlalchemy import insert, update
+from db import Chat, Message
+from persistence import MessageWriter
+import history as history_module
+from history import HistoryCache, load_history
+
+def add_chat(engine) -> str:
+    chat_id = str(uuid.uuid4())
+    with engine.begin() as conn:
+        conn.execute(insert(Chat).values(id=chat_id, prompt_template_id="template"))
+    return chat_id
+
+def add_message(engine, chat_id: str, role: str, content: str):
+    with engine.begin() as conn:
+        conn.execute(insert(Message).values(
+            id=str(uuid.uuid4()), chat_id=chat_id, role=role, content=content, created_at=datetime.now(),
+        ))
+
+def test_cached_history_sees_other_workers_writes(db, monkeypatch):
+    monkeypatch.setattr(history_module, "history_cache", HistoryCache(10))
+    chat_id = add_chat(db)
+
+    async def run():
+        first = await load_history(chat_id)
+        assert first.messages == []
+        # 別のワーカーがこのチャットのターンを保存した
+        add_message(db, chat_id, "user", "こんにちは")
+        add_message(db, chat_id, "assistant", "いらっしゃいませ")
+        second = await load_history(chat_id)
+        assert [m["content"] for m in second.messages] == ["こんにちは", "いらっしゃいませ"]
+        # 別のワーカーの整理で旧形式から現行のテンプレートに切り替わった
+        with db.begin() as conn:
+            conn.execute(update(Chat).where(Chat.id == chat_id).values(prompt_template_id="current"))
+        third = await load_history(chat_id)
+        assert third.prompt_template_id == "current"
+
+    asyncio.run(run())
+
+def test_queued_writes_do_not_invalidate_cache(db, monkeypatch):
+    cache = HistoryCache(10)
+    writer = MessageWriter(interval=60)
+    monkeypatch.setattr(history_module, "history_cache", cache)
+    monkeypatch.setattr(history_module, "message_writer", writer)
+    chat_id = add_chat(db)
+
+    async def run():
+        await writer.start()
+        history = await load_history(chat_id)
+        # chat_turnと同じく、キューに入れてからキャッシュに追加する
+        await writer.write(chat_id, "user", "こんにちは")
+        history.messages.append({"role": "user", "content": "こんにちは"})
+        assert writer.pending(chat_id) == 1
+        assert await load_history(chat_id) is history
+        await writer.stop()
+        assert writer.pending(chat_id) == 0
+        assert await load_history(chat_id) is history
+
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from idempotency import TurnStore
+
+async def events(count: int, gate: asyncio.Event | None = None):
+    for i in range(count):
+        if gate is not None and i == 1:
+            await gate.wait()
+        yield f"event-{i}\n"
+
+def test_claim_returns_the_same_turn_for_a_retry():
+    async def run():
+        store = TurnStore(ttl=60)
+        turn, created = store.claim("chat", "key", "おすすめは？")
+        assert created
+        again, created = store.claim("chat", "key", "おすすめは？")
+        assert again is turn and not created
+        with pytest.raises(HTTPException) as e:
+            store.claim("chat", "key", "別の質問")
+        assert e.value.status_code == 422
+
+    asyncio.run(run())
+
+def test_replay_resumes_from_an_index_and_waits_for_the_rest():
+    async def run():
+        store = TurnStore(ttl=60)
+        turn, _ = store.claim("chat", "key", "おすすめは？")
+        gate = asyncio.Event()
+        store.start("chat", "key", turn, events(3, gate), [])
+        replay = turn.replay(1)
+        pending = asyncio.ensure_future(anext(replay))
+        await asyncio.sleep(0)
+        assert not pending.done()
+        gate.set()
+        assert await pending == "event-1\n"
+        assert [event async for event in replay] == ["event-2\n"]
+
+    asyncio.run(run())
+
+def test_purge_keeps_unfinished_turns_over_the_limit():
+    async def run():
+        store = TurnStore(ttl=60, max_turns=1)
+        running, _ = store.claim("chat", "running", "a")
+        store.start("chat", "running", running, events(2, asyncio.Event()), [])
+        finished, _ = store.claim("chat", "finished", "b")
+        store.start("chat", "finished", finished, events(1), [])
+        await finished.task
+        store.claim("chat", "new", "c")
+        # 生成中のターンは上限を超えても捨てず、終わったターンから捨てる
+        assert store.claim("chat", "running", "a") == (running, False)
+        assert store.claim("chat", "finished", "b")[1]
+        running.task.cancel()
+
+    asyncio.run(run())
+
+def test_retry_resumes_the_stream_from_x_resume_from(db):
+    import main
+
+    with TestClient(main.app) as client:
+        chat_id = client.post("/start_chat").json()["chat_id"]
+        headers = {"Idempotency-Key": "turn-1"}
+        first = [json.loads(line) for line in client.post(f"/chat/{chat_id}", json={"content": "こんにちは"}, headers=headers).text.splitlines()]
+        assert first[-1] == {"index": len(first) - 1, "status": "finished"}
+
+        retry = client.post(f"/chat/{chat_id}", json={"content": "こんにちは"}, headers={**headers, "X-Resume-From": "1"})
+        assert [json.loads(line) for line in retry.text.splitlines()] == first[1:]
+        history = client.get(f"/chat/{chat_id}/messages").json()
+    # 再送ではモデルを呼び直さず、ターンも1回分だけ保存される
+    assert [m["role"] for m in history["messages"]] == ["user", "assistant"]
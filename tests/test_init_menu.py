@@ -0,0 +1,28 @@
+from sqlalchemy import select
+from db import Menu
+from init_menu import to_row, upsert_menus
+
+MENUS = [
+    {"id": "jasmine", "name": "ジャスミン茶", "category": "beverage", "allergies": []},
+    {"id": "coffee", "name": "ブラックコーヒー", "category": "beverage", "allergies": []},
+]
+
+def load(engine) -> dict[str, tuple]:
+    with engine.connect() as conn:
+        rows = conn.execute(select(Menu.id, Menu.name, Menu.description, Menu.updated_at)).all()
+    return {row.id: row for row in rows}
+
+def test_reload_is_idempotent(db):
+    upsert_menus([to_row(m) for m in MENUS])
+    first = load(db)
+    upsert_menus([to_row(m) for m in MENUS])
+    # 内容が同じ行はupdated_atも変えない
+    assert load(db) == first
+
+def test_rename_keeps_the_id(db):
+    upsert_menus([to_row(m) for m in MENUS])
+    renamed = [dict(MENUS[0], name="ジャスミンティー", description="香りのよいお茶"), MENUS[1]]
+    upsert_menus([to_row(m) for m in renamed])
+    rows = load(db)
+    assert set(rows) == {"jasmine", "coffee"}
+    assert (rows["jasmine"].name, rows["jasmine"].description) == ("ジャスミンティー", "香りのよいお茶")
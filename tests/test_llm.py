@@ -0,0 +1,59 @@
+import asyncio
+import llm
+
+class CountingProvider:
+    """呼ばれた回数を数え、releaseされるまで最後のチャンクを返さないプロバイダ"""
+    def __init__(self):
+        self.calls = 0
+        self.closed = False
+        self.release = asyncio.Event()
+
+    async def stream(self, messages, model: str):
+        self.calls += 1
+        try:
+            yield "おすすめは"
+            await self.release.wait()
+            yield "緑茶です。"
+        finally:
+            self.closed = True
+
+MESSAGES = [{"role": "user", "content": "おすすめは？"}]
+
+def test_identical_requests_share_one_upstream_stream(monkeypatch):
+    async def run():
+        provider = CountingProvider()
+        monkeypatch.setattr(llm, "_provider", provider)
+        assert not llm.in_flight(MESSAGES)
+        leader = llm.stream_openai(MESSAGES)
+        assert await anext(leader) == "おすすめは"
+        # 後から来たリクエストは進行中のストリームに相乗りし、最初から受け取る
+        assert llm.in_flight(MESSAGES)
+        follower = llm.stream_openai(MESSAGES)
+        assert await anext(follower) == "おすすめは"
+        provider.release.set()
+        assert [d async for d in leader] == ["緑茶です。"]
+        assert [d async for d in follower] == ["緑茶です。"]
+        assert provider.calls == 1
+        assert not llm.in_flight(MESSAGES)
+
+    asyncio.run(run())
+
+def test_upstream_is_closed_when_the_last_subscriber_leaves(monkeypatch):
+    async def run():
+        provider = CountingProvider()
+        monkeypatch.setattr(llm, "_provider", provider)
+        first = llm.stream_openai(MESSAGES)
+        second = llm.stream_openai(MESSAGES)
+        assert await anext(first) == "おすすめは"
+        assert await anext(second) == "おすすめは"
+        flight = llm._inflight[llm.fingerprint(MESSAGES)]
+
+        await first.aclose()
+        # まだ受け取っているリクエストがあるため上流は続ける
+        assert not flight.task.done()
+        await second.aclose()
+        await asyncio.gather(flight.task, return_exceptions=True)
+        assert flight.task.cancelled() and provider.closed
+        assert not llm.in_flight(MESSAGES)
+
+    asyncio.run(run())
@@ -0,0 +1,129 @@
+import asyncio
+import glob
+import gzip
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select
+from config import ARCHIVE_DIR
+from db import Chat, Message
+from maintenance import Maintenance
+from persistence import MessageWriter
+from prompt import FEW_SHOT_EXAMPLES, LEGACY_SEED_COUNT, SYSTEM_PROMPT
+import maintenance as maintenance_module
+
+OLD = datetime.now() - timedelta(days=365)
+
+def add_chat(engine, contents: list[tuple[str, str]], template_id: str | None = None, start: datetime = OLD) -> str:
+    chat_id = str(uuid.uuid4())
+    with engine.begin() as conn:
+        conn.execute(insert(Chat).values(id=chat_id, created_at=start, prompt_template_id=template_id))
+        conn.execute(insert(Message), [
+            {"id": str(uuid.uuid4()), "chat_id": chat_id, "role": role, "content": content, "created_at": start + timedelta(seconds=i)}
+            for i, (role, content) in enumerate(contents)
+        ])
+    return chat_id
+
+def legacy_seed() -> list[tuple[str, str]]:
+    rows = [("system", SYSTEM_PROMPT)]
+    for question, answer in FEW_SHOT_EXAMPLES:
+        rows += [("user", question), ("assistant", answer)]
+    assert len(rows) == LEGACY_SEED_COUNT
+    return rows
+
+def all_messages(engine) -> list:
+    with engine.connect() as conn:
+        return conn.execute(
+            select(Message.id, Message.chat_id, Message.role, Message.content, Message.created_at)
+            .order_by(Message.created_at, Message.id)
+        ).all()
+
+def read_archive() -> dict[str, dict]:
+    chats = {}
+    for path in glob.glob(os.path.join(ARCHIVE_DIR, "chats-*")):
+        if path.endswith(".zst"):
+            import zstandard
+            with open(path, "rb") as f:
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(f.read())
+        else:
+            with open(path, "rb") as f:
+                data = gzip.decompress(f.read())
+        for line in data.decode("utf-8").splitlines():
+            chat = json.loads(line)
+            chats[chat["chat_id"]] = chat
+    return chats
+
+def clear_archive():
+    for path in glob.glob(os.path.join(ARCHIVE_DIR, "chats-*")):
+        os.remove(path)
+
+def test_expire_archives_every_deleted_row(db):
+    clear_archive()
+    question, answer = FEW_SHOT_EXAMPLES[0]
+    # 実際の会話でfew-shotの例と同じ質問をし、同じ答えが返ったチャット
+    legacy = add_chat(db, legacy_seed() + [
+        ("user", question),
+        ("assistant", answer),
+        ("user", "ありがとう"),
+        ("assistant", "どういたしまして"),
+    ])
+    templated = add_chat(db, [("user", "おすすめは？"), ("assistant", "「ブラックコーヒー」です。")], template_id="template")
+    recent = add_chat(db, [("user", "こんにちは")], start=datetime.now())
+    before = all_messages(db)
+
+    archived = asyncio.run(Maintenance(interval=0, pause=0).expire())
+
+    assert archived == 2
+    after = all_messages(db)
+    assert {row.chat_id for row in after} == {recent}
+    deleted = [row for row in before if row.chat_id != recent]
+    seed_ids = {row.id for row in [row for row in deleted if row.chat_id == legacy][:LEGACY_SEED_COUNT]}
+
+    chats = read_archive()
+    assert set(chats) == {legacy, templated}
+    for chat_id in (legacy, templated):
+        expected = [
+            {"id": row.id, "role": row.role, "content": row.content, "created_at": row.created_at.isoformat()}
+            for row in deleted
+            if row.chat_id == chat_id and row.id not in seed_ids and row.role != "system"
+        ]
+        assert chats[chat_id]["messages"] == expected
+    # few-shotと同じ本文でもシード行より後の発話はアーカイブされる
+    assert [m["content"] for m in chats[legacy]["messages"]] == [question, answer, "ありがとう", "どういたしまして"]
+    assert chats[templated]["prompt_template_id"] == "template"
+
+def test_expire_commits_queued_messages_first(db, monkeypatch):
+    clear_archive()
+    chat_id = add_chat(db, [("user", "おすすめは？"), ("assistant", "「ブラックコーヒー」です。")], template_id="template")
+    writer = MessageWriter(interval=60)
+    monkeypatch.setattr(maintenance_module, "message_writer", writer)
+
+    async def run():
+        await writer.start()
+        # まだコミットされていない新しいメッセージがあるチャットは削除しない
+        await writer.write(chat_id, "user", "まだありますか？")
+        archived = await Maintenance(interval=0, pause=0).expire()
+        await writer.stop()
+        return archived
+
+    assert asyncio.run(run()) == 0
+    rows = all_messages(db)
+    assert [row.content for row in rows] == ["おすすめは？", "「ブラックコーヒー」です。", "まだありますか？"]
+    with db.connect() as conn:
+        assert conn.execute(select(Chat.id)).scalars().all() == [chat_id]
+
+def test_expire_writes_the_archive_off_the_event_loop(db, monkeypatch):
+    clear_archive()
+    add_chat(db, [("user", "おすすめは？"), ("assistant", "「ブラックコーヒー」です。")], template_id="template")
+    threads = []
+    write_archive = maintenance_module.write_archive
+
+    def record_thread(path, lines):
+        threads.append(threading.current_thread())
+        write_archive(path, lines)
+
+    monkeypatch.setattr(maintenance_module, "write_archive", record_thread)
+    assert asyncio.run(Maintenance(interval=0, pause=0).expire()) == 1
+    assert threads and threading.main_thread() not in threads